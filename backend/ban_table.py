@@ -0,0 +1,202 @@
+"""
+Shared-memory table of active bans for multi-worker deployments.
+
+One leader process (elected with flock) writes the sorted ban list into a
+memory-mapped file. Every worker maps the same file and answers ban checks
+with a binary search over it, without copying the data or querying MongoDB.
+
+File layout (native int64, little-endian header):
+  header   magic (8s) | generation (Q) | count (Q) | flags (Q)
+  ids      capacity x int64, sorted ascending, the first `count` are used
+  expires  capacity x int64, ms since the epoch, 0 = permanent
+
+The generation is a seqlock: the writer makes it odd while it rewrites the
+arrays and even again afterwards, so readers retry instead of locking. When
+the table outgrows the file, the writer builds a larger file next to it,
+swaps it in with os.replace and flags the old mapping as stale so readers
+map the new one.
+"""
+
+import bisect
+import fcntl
+import mmap
+import os
+import struct
+import time
+from array import array
+from typing import Iterable, Optional, Tuple
+
+MAGIC = b"TGBANS01"
+HEADER = struct.Struct("<8sQQQ")
+COUNTER = struct.Struct("<Q")
+GENERATION_OFFSET = 8
+COUNT_OFFSET = 16
+FLAGS_OFFSET = 24
+FLAG_STALE = 1
+FLAG_PUBLISHED = 2
+
+MIN_CAPACITY = 1024
+REOPEN_INTERVAL = 1.0  # Seconds between attempts to map a missing/stale file
+READ_RETRIES = 100
+
+INT64_MIN = -(2 ** 63)
+INT64_MAX = 2 ** 63 - 1
+
+
+class TableUnavailable(RuntimeError):
+    """The shared table can't answer (not published yet or mid-write)"""
+
+
+class SharedBanTable:
+    def __init__(self, path: str):
+        self.path = path
+        self.leader = False
+        self.lock_file = None
+        self.file = None
+        self.mm = None
+        self.view = None
+        self.ids = None
+        self.expires = None
+        self.capacity = 0
+        self._next_open = 0.0
+
+    # ---------- mapping ----------
+
+    def _map(self, file, writable: bool) -> bool:
+        access = mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ
+        try:
+            mm = mmap.mmap(file.fileno(), 0, access=access)
+        except ValueError:  # Empty file
+            file.close()
+            return False
+        if len(mm) < HEADER.size or mm[:len(MAGIC)] != MAGIC:
+            mm.close()
+            file.close()
+            return False
+        self._unmap()
+        capacity = (len(mm) - HEADER.size) // 16
+        self.file = file
+        self.mm = mm
+        self.view = memoryview(mm)
+        self.ids = self.view[HEADER.size:HEADER.size + capacity * 8].cast("q")
+        self.expires = self.view[HEADER.size + capacity * 8:HEADER.size + capacity * 16].cast("q")
+        self.capacity = capacity
+        return True
+
+    def _unmap(self):
+        # Exported memoryviews must be released before the mmap can close
+        for view in (self.ids, self.expires, self.view):
+            if view is not None:
+                view.release()
+        self.ids = self.expires = self.view = None
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.capacity = 0
+
+    def close(self):
+        self._unmap()
+        if self.lock_file is not None:
+            # Closing the descriptor releases the flock for the next leader
+            self.lock_file.close()
+            self.lock_file = None
+        self.leader = False
+
+    # ---------- writer ----------
+
+    def try_lead(self) -> bool:
+        """Become the writer if no other process holds the lock"""
+        if self.leader:
+            return True
+        if self.lock_file is None:
+            self.lock_file = open(self.path + ".lock", "a+b")
+        try:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        self.leader = True
+        try:
+            if not self._map(open(self.path, "r+b"), writable=True):
+                self._create(MIN_CAPACITY)
+        except FileNotFoundError:
+            self._create(MIN_CAPACITY)
+        return True
+
+    def _create(self, capacity: int):
+        """Write an empty file of `capacity` slots and swap it in atomically"""
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.truncate(HEADER.size + capacity * 16)
+            f.write(HEADER.pack(MAGIC, 0, 0, 0))
+        os.replace(tmp, self.path)
+        old = self.mm
+        if old is not None:
+            # Readers still mapping the replaced file switch over
+            COUNTER.pack_into(old, FLAGS_OFFSET, FLAG_STALE)
+        self._map(open(self.path, "r+b"), writable=True)
+
+    def publish(self, entries: Iterable[Tuple[int, int]]):
+        """Replace the table with (user_id, expires_ms) pairs; leader only"""
+        entries = sorted(entries)
+        count = len(entries)
+        if count > self.capacity:
+            self._create(max(MIN_CAPACITY, count * 2))
+        generation = COUNTER.unpack_from(self.mm, GENERATION_OFFSET)[0]
+        generation += generation & 1  # A writer that died mid-write left it odd
+        COUNTER.pack_into(self.mm, GENERATION_OFFSET, generation + 1)
+        self.ids[:count] = array("q", (user_id for user_id, _ in entries))
+        self.expires[:count] = array("q", (expires for _, expires in entries))
+        COUNTER.pack_into(self.mm, COUNT_OFFSET, count)
+        COUNTER.pack_into(self.mm, FLAGS_OFFSET, FLAG_PUBLISHED)
+        COUNTER.pack_into(self.mm, GENERATION_OFFSET, generation + 2)
+
+    # ---------- reader ----------
+
+    def ready(self) -> bool:
+        """Map the published file if needed; False while there is none"""
+        now = time.monotonic()
+        if self.mm is not None:
+            if not COUNTER.unpack_from(self.mm, FLAGS_OFFSET)[0] & FLAG_STALE:
+                return True
+        elif now < self._next_open:
+            return False
+        self._next_open = now + REOPEN_INTERVAL
+        try:
+            return self._map(open(self.path, "rb"), writable=False)
+        except FileNotFoundError:
+            self._unmap()
+            return False
+
+    def lookup(self, user_id: int) -> Optional[int]:
+        """Expiry in ms (0 = permanent) if user_id is listed, otherwise None"""
+        if not self.ready():
+            raise TableUnavailable(self.path)
+        mm, ids, expires = self.mm, self.ids, self.expires
+        for _ in range(READ_RETRIES):
+            generation = COUNTER.unpack_from(mm, GENERATION_OFFSET)[0]
+            if generation & 1:
+                continue
+            if not COUNTER.unpack_from(mm, FLAGS_OFFSET)[0] & FLAG_PUBLISHED:
+                # A fresh file: an empty table must not read as "nobody is banned"
+                raise TableUnavailable(self.path)
+            count = min(COUNTER.unpack_from(mm, COUNT_OFFSET)[0], self.capacity)
+            i = bisect.bisect_left(ids, user_id, 0, count)
+            found = i < count and ids[i] == user_id
+            expires_ms = expires[i] if found else None
+            if COUNTER.unpack_from(mm, GENERATION_OFFSET)[0] == generation:
+                return expires_ms
+        raise TableUnavailable(self.path)
+
+
+def to_table_id(user_id: str) -> Optional[int]:
+    """Telegram ids fit in int64; anything else (or non-canonical) stays out of the table"""
+    try:
+        value = int(user_id)
+    except (TypeError, ValueError):
+        return None
+    if str(value) != user_id or not INT64_MIN <= value <= INT64_MAX:
+        return None
+    return value
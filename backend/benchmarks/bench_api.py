@@ -0,0 +1,278 @@
+"""
+End-to-end API benchmark for server.py, run fully in-process.
+
+The FastAPI app is driven through httpx's ASGI transport (no sockets, no
+uvicorn) against either mongomock-motor or a local mongod, so it needs no
+external service. For each scenario and concurrency level it reports
+throughput and p50/p95/p99 latency:
+
+  ban_check        GET    /api/banned/{user_id}
+  ban_check_bulk   POST   /api/banned/check (100 ids)
+  ban_unban        POST   /api/banned + DELETE /api/banned/{user_id}
+  status_insert    POST   /api/status
+  status_list      GET    /api/status?limit=100
+  banned_list      GET    /api/banned?limit=100
+
+Right before each scenario/concurrency result the run measures a short
+reference operation (ban_check at concurrency 10, stored next to the result)
+and expresses the result relative to it: rps_ratio = rps / reference
+rps, p95_ratio = p95 / reference p95. Baselines are stored as JSON per
+backend, and the check compares these ratios, not absolute timings, so a
+faster or slower host shifts the reference and the scenarios alike. Without
+--update-baseline the run exits with status 1 when a ratio regresses by more
+than --tolerance. Ratios still move with the host's CPU/IO balance, and on
+mongomock heavier scenarios vary by up to ~40% between runs on one machine,
+hence the wide default. Regenerate the baseline with --update-baseline when
+the check moves to a different kind of machine; with --scenarios only those
+entries are replaced, which is safe because every ratio is relative to its
+own run's reference. On mongod, raise --requests before tightening the
+tolerance.
+
+Usage:
+  python backend/benchmarks/bench_api.py [--backend mock|mongod] [--concurrency 10 100 1000]
+                                         [--requests N] [--update-baseline] [--tolerance 0.5]
+
+--backend mongod uses MONGO_URL (default mongodb://localhost:27017) and drops
+the --db database (default bench_api) before seeding.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import sys
+import time
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+BASELINE_DIR = BENCH_DIR / "baselines"
+
+SEED_BANS = 500
+SEED_STATUS_CHECKS = 1000
+BULK_CHECK_SIZE = 100
+USER_ID_BASE = 100_000_000
+# Operation every result is expressed against, measured in the same run
+REFERENCE_SCENARIO = "ban_check"
+REFERENCE_CONCURRENCY = 10
+REFERENCE_REQUESTS = 1000
+
+
+def ban_check(i, uid):
+    # Half of the ids are banned (seeded), half are not
+    return [("GET", f"/api/banned/{USER_ID_BASE + i % (SEED_BANS * 2)}", None)]
+
+
+def ban_check_bulk(i, uid):
+    start = (i * BULK_CHECK_SIZE) % (SEED_BANS * 2)
+    ids = [str(USER_ID_BASE + (start + k) % (SEED_BANS * 2)) for k in range(BULK_CHECK_SIZE)]
+    return [("POST", "/api/banned/check", {"user_ids": ids})]
+
+
+def ban_unban(i, uid):
+    user_id = str(next(uid))
+    return [
+        ("POST", "/api/banned", {"user_id": user_id, "days": 1, "banned_by": "bench"}),
+        ("DELETE", f"/api/banned/{user_id}", None),
+    ]
+
+
+def status_insert(i, uid):
+    return [("POST", "/api/status", {"client_name": f"bench-{i % 50}"})]
+
+
+def status_list(i, uid):
+    return [("GET", "/api/status?limit=100", None)]
+
+
+def banned_list(i, uid):
+    return [("GET", "/api/banned?limit=100", None)]
+
+
+SCENARIOS = {
+    "ban_check": ban_check,
+    "ban_check_bulk": ban_check_bulk,
+    "ban_unban": ban_unban,
+    "status_insert": status_insert,
+    "status_list": status_list,
+    "banned_list": banned_list,
+}
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+
+async def run_scenario(client, scenario, concurrency: int, total: int, uid) -> dict:
+    """`concurrency` workers share `total` operations; every request is timed"""
+    latencies = []
+    errors = 0
+    operations = iter(range(total))
+
+    async def worker():
+        nonlocal errors
+        for i in operations:
+            for method, url, body in scenario(i, uid):
+                started = time.perf_counter()
+                response = await client.request(method, url, json=body)
+                latencies.append(time.perf_counter() - started)
+                if response.status_code >= 400:
+                    errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+async def seed(client):
+    for k in range(SEED_BANS):
+        # Even offsets are banned, odd offsets stay clean
+        user_id = str(USER_ID_BASE + k * 2)
+        response = await client.post("/api/banned", json={"user_id": user_id, "days": 30 if k % 2 else None})
+        response.raise_for_status()
+    batch = [{"client_name": f"seed-{k % 50}"} for k in range(SEED_STATUS_CHECKS)]
+    response = await client.post("/api/status/bulk", json=batch)
+    response.raise_for_status()
+
+
+def prepare_server(args):
+    """Import server.py configured for the chosen backend"""
+    os.environ["DB_NAME"] = args.db
+    os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+    if args.backend == "mock":
+        # mongomock has no change streams
+        os.environ["BAN_CACHE_SYNC"] = "poll"
+        os.environ["ORDER_BOOK_SYNC"] = "poll"
+    sys.path.insert(0, str(BENCH_DIR.parent))
+    import server
+
+    if args.backend == "mock":
+        try:
+            from mongomock_motor import AsyncMongoMockClient
+        except ImportError:
+            sys.exit("mongomock-motor is required for --backend mock (pip install mongomock-motor)")
+        # connect_mongo() keeps a client that is already set
+        server.client = AsyncMongoMockClient(tz_aware=True)
+    else:
+        server.connect_mongo()
+    return server
+
+
+def add_ratios(stats: dict, reference: dict):
+    stats["rps_ratio"] = round(stats["rps"] / reference["rps"], 4)
+    stats["p95_ratio"] = round(stats["p95_ms"] / reference["p95_ms"], 4)
+    stats["reference_rps"] = reference["rps"]
+    stats["reference_p95_ms"] = reference["p95_ms"]
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for name, levels in results["scenarios"].items():
+        for level, current in levels.items():
+            base = baseline["scenarios"].get(name, {}).get(level)
+            if not base:
+                continue
+            if current["rps_ratio"] < base["rps_ratio"] * (1 - tolerance):
+                regressions.append(
+                    f"{name} @ {level}: rps {base['rps_ratio']}x -> {current['rps_ratio']}x reference"
+                )
+            if current["p95_ratio"] > base["p95_ratio"] * (1 + tolerance):
+                regressions.append(
+                    f"{name} @ {level}: p95 {base['p95_ratio']}x -> {current['p95_ratio']}x reference"
+                )
+    return regressions
+
+
+async def run(args) -> dict:
+    import httpx
+
+    server = prepare_server(args)
+    if args.backend == "mongod":
+        await server.client.drop_database(args.db)
+
+    scenarios = {}
+    uid = itertools.count(900_000_000)
+    async with server.app.router.lifespan_context(server.app):
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            await seed(client)
+            for name in args.scenarios:
+                scenarios[name] = {}
+                for concurrency in args.concurrency:
+                    # Measured right before each result, so host drift during a long run cancels out
+                    reference = await run_scenario(
+                        client, SCENARIOS[REFERENCE_SCENARIO], REFERENCE_CONCURRENCY, REFERENCE_REQUESTS, uid
+                    )
+                    stats = await run_scenario(client, SCENARIOS[name], concurrency, args.requests, uid)
+                    add_ratios(stats, reference)
+                    scenarios[name][str(concurrency)] = stats
+                    print(
+                        f"{name:<16}{concurrency:>6}{stats['rps']:>11.1f}"
+                        f"{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}{stats['p99_ms']:>10.2f}"
+                        f"{stats['errors']:>8}{stats['rps_ratio']:>9.3f}{stats['p95_ratio']:>9.3f}"
+                    )
+    reference = {"scenario": REFERENCE_SCENARIO, "concurrency": REFERENCE_CONCURRENCY, "requests": REFERENCE_REQUESTS}
+    return {"reference": reference, "scenarios": scenarios}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", choices=["mock", "mongod"], default="mock")
+    parser.add_argument("--db", default="bench_api")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--requests", type=int, default=2000, help="operations per scenario and concurrency level")
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--baseline", type=Path, help="baseline file (default: baselines/api-<backend>.json)")
+    parser.add_argument("--update-baseline", action="store_true", help="store this run as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="allowed relative regression of a ratio (0.5 = 50%%)")
+    args = parser.parse_args()
+
+    # Per-request INFO logs would dominate the measurement
+    logging.disable(logging.INFO)
+
+    print(
+        f"{'scenario':<16}{'conc':>6}{'req/s':>11}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}"
+        f"{'rps/ref':>9}{'p95/ref':>9}"
+    )
+    results = asyncio.run(run(args))
+
+    baseline_path = args.baseline or BASELINE_DIR / f"api-{args.backend}.json"
+    if args.update_baseline:
+        if baseline_path.exists():
+            previous = json.loads(baseline_path.read_text())
+            if "reference" in previous:
+                results["scenarios"] = {**previous["scenarios"], **results["scenarios"]}
+        baseline_path.parent.mkdir(parents=True, exist_ok=True)
+        baseline_path.write_text(json.dumps(results, indent=2, sort_keys=True) + "\n")
+        print(f"\nBaseline written to {baseline_path}")
+        return
+    if not baseline_path.exists():
+        print(f"\nNo baseline at {baseline_path}; run with --update-baseline to record one")
+        return
+
+    baseline = json.loads(baseline_path.read_text())
+    if "reference" not in baseline:
+        print(f"\n{baseline_path} holds absolute timings only; re-record it with --update-baseline")
+        sys.exit(1)
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print("\nRegressions against baseline:")
+        for line in regressions:
+            print(f"  {line}")
+        sys.exit(1)
+    print(f"\nNo regressions against {baseline_path} (tolerance {args.tolerance:.0%})")
+
+
+if __name__ == "__main__":
+    main()
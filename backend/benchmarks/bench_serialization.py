@@ -0,0 +1,97 @@
+"""
+Serialization benchmark for listing responses in server.py.
+
+Compares, for 1k and 10k rows of status checks and bans:
+  default  - jsonable_encoder + JSONResponse (FastAPI's stock path)
+  orjson   - jsonable_encoder + ORJSONResponse (default_response_class only)
+  direct   - server.json_response, which hands documents straight to orjson
+
+Usage: python backend/benchmarks/bench_serialization.py [--repeat N]
+"""
+
+import argparse
+import os
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+# server.py reads these at import time; the Motor client connects lazily, so no Mongo is needed
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "bench")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from fastapi.responses import JSONResponse, ORJSONResponse  # noqa: E402
+
+import server  # noqa: E402
+
+
+def status_rows(count: int) -> list:
+    start = datetime.now(timezone.utc)
+    return [
+        {"id": str(uuid.uuid4()), "client_name": f"agent-{i % 50}", "timestamp": start + timedelta(seconds=i)}
+        for i in range(count)
+    ]
+
+
+def ban_rows(count: int) -> list:
+    now = datetime.now(timezone.utc)
+    return [
+        {
+            "id": str(uuid.uuid4()),
+            "user_id": str(100000000 + i),
+            "username": f"user{i}",
+            "banned_at": now,
+            "banned_until": now + timedelta(days=i % 30) if i % 3 else None,
+            "banned_by": "admin",
+        }
+        for i in range(count)
+    ]
+
+
+def render_default(rows):
+    return JSONResponse(jsonable_encoder(rows)).body
+
+
+def render_orjson(rows):
+    return ORJSONResponse(jsonable_encoder(rows)).body
+
+
+def render_direct(rows):
+    return server.json_response(rows).body
+
+
+def measure(func, rows, repeat: int) -> float:
+    """Best wall time in milliseconds over `repeat` runs"""
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(rows)
+        best = min(best, time.perf_counter() - started)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    variants = [("default", render_default), ("orjson", render_orjson)]
+    if server.orjson:
+        variants.append(("direct", render_direct))
+    else:
+        print("orjson is not installed: server.json_response uses the default path\n")
+
+    print(f"{'listing':<16}{'rows':>7}" + "".join(f"{name:>12}" for name, _ in variants) + f"{'speedup':>10}")
+    for name, factory in [("status_checks", status_rows), ("banned_users", ban_rows)]:
+        for count in (1_000, 10_000):
+            rows = factory(count)
+            timings = [measure(func, rows, args.repeat) for _, func in variants]
+            cells = "".join(f"{ms:>10.2f}ms" for ms in timings)
+            print(f"{name:<16}{count:>7}{cells}{timings[0] / timings[-1]:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
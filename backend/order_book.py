@@ -0,0 +1,366 @@
+"""
+In-memory order books per (project, server) with price-time priority.
+
+Open orders are approved buy/sell orders younger than the age window: buys are
+bids and sells are asks. Filled orders leave once they are "completed", stale
+ones when they age out. Each side is a binary heap of (price per 1kk, created
+ms, seq, order_id) tuples. Removal is lazy: the order leaves `orders` and its
+heap entry is skipped once it reaches the top, so adds, removals and best-price
+lookups are O(log n). Heaps are compacted when stale entries outnumber live ones.
+
+The books are derived data: server.py applies its own order writes at once and
+follows the other workers' writes through a change stream or by polling
+updated_at, so each change costs one sync(). Full rebuilds from Mongo happen at
+startup and on resync only. Snapshots on disk (written by one worker) make the
+books available before the first rebuild finishes.
+"""
+
+import fcntl
+import heapq
+import itertools
+import json
+import os
+import time
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+
+BUY = "buy"
+SELL = "sell"
+OPPOSITE = {BUY: SELL, SELL: BUY}
+
+# Rebuild a heap once it holds this many more entries than live orders
+COMPACT_SLACK = 64
+
+SNAPSHOT_VERSION = 1
+
+# Amounts are in game currency; prices are quoted per 1kk
+UNIT = 1_000_000
+
+
+class OrderBook:
+    __slots__ = ("heaps", "orders", "volume")
+
+    def __init__(self):
+        # Bids are keyed by -unit price so both sides pop their best order first
+        self.heaps = {BUY: [], SELL: []}
+        self.orders = {}  # order_id -> (side, price, amount, user_id, created_ms, seq, unit_price)
+        self.volume = {BUY: 0, SELL: 0}
+
+    def add(self, order_id: str, side: str, price: float, amount: int, user_id, created_ms: int, seq: int):
+        if order_id in self.orders:
+            self.remove(order_id)
+        unit = unit_price(price, amount)
+        self.orders[order_id] = (side, price, amount, user_id, created_ms, seq, unit)
+        self.volume[side] += amount
+        heap = self.heaps[side]
+        heapq.heappush(heap, (-unit if side == BUY else unit, created_ms, seq, order_id))
+        if len(heap) > 2 * len(self.orders) + COMPACT_SLACK:
+            self._compact(side)
+
+    def remove(self, order_id: str) -> bool:
+        order = self.orders.pop(order_id, None)
+        if order is None:
+            return False
+        self.volume[order[0]] -= order[2]
+        return True
+
+    def _live(self, entry: tuple) -> bool:
+        # A re-added order gets a new seq, so its older heap entry stays stale
+        order = self.orders.get(entry[3])
+        return order is not None and order[5] == entry[2]
+
+    def _compact(self, side: str):
+        heap = [entry for entry in self.heaps[side] if self._live(entry)]
+        heapq.heapify(heap)
+        self.heaps[side] = heap
+
+    def _view(self, order_id: str) -> dict:
+        side, price, amount, user_id, created_ms, _, unit = self.orders[order_id]
+        return {
+            "id": order_id, "order_type": side, "price": price, "unit_price": unit,
+            "amount": amount, "user_id": user_id, "created_ms": created_ms,
+        }
+
+    def best(self, side: str) -> Optional[dict]:
+        """Top of one side: highest bid or lowest ask per 1kk, earliest first on ties"""
+        heap = self.heaps[side]
+        while heap and not self._live(heap[0]):
+            heapq.heappop(heap)
+        return self._view(heap[0][3]) if heap else None
+
+    def ordered(self, side: str) -> Iterator[dict]:
+        """Live orders of one side in priority order (pops from a copy of the heap)"""
+        heap = list(self.heaps[side])
+        while heap:
+            entry = heapq.heappop(heap)
+            if self._live(entry):
+                yield self._view(entry[3])
+
+    def top(self, side: str, depth: int) -> List[dict]:
+        entries = heapq.nsmallest(depth, (e for e in self.heaps[side] if self._live(e)))
+        return [self._view(entry[3]) for entry in entries]
+
+    def counterparty(self, side: str, unit: float, user_id=None) -> Optional[dict]:
+        """Best order on the opposite side that crosses `unit` (price per 1kk), never the user's own"""
+        for order in self.ordered(OPPOSITE[side]):
+            crosses = order["unit_price"] <= unit if side == BUY else order["unit_price"] >= unit
+            if not crosses:
+                return None
+            if user_id is None or order["user_id"] != user_id:
+                return order
+        return None
+
+    def matches(self, limit: int) -> List[dict]:
+        """Fills that price-time matching would produce right now; the book is not changed"""
+        asks = self.ordered(SELL)
+        pulled = []  # [ask, amount left] in priority order, taken from `asks` on demand
+        fills = []
+        for bid in self.ordered(BUY):
+            bid_left = bid["amount"]
+            i = 0
+            while bid_left and len(fills) < limit:
+                if i == len(pulled):
+                    ask = next(asks, None)
+                    if ask is None:
+                        break
+                    pulled.append([ask, ask["amount"]])
+                ask, ask_left = pulled[i]
+                if ask["unit_price"] > bid["unit_price"]:
+                    break
+                if ask["user_id"] == bid["user_id"]:
+                    # No self-trades; the ask stays available to later bids
+                    i += 1
+                    continue
+                amount = min(bid_left, ask_left)
+                # The order that rested on the book first sets the price
+                resting = bid if (bid["created_ms"], bid["id"]) < (ask["created_ms"], ask["id"]) else ask
+                fills.append({
+                    "buy_order_id": bid["id"],
+                    "sell_order_id": ask["id"],
+                    "buyer_id": bid["user_id"],
+                    "seller_id": ask["user_id"],
+                    "amount": amount,
+                    "unit_price": resting["unit_price"],
+                    "total": round(resting["unit_price"] * amount / UNIT, 2),
+                })
+                bid_left -= amount
+                if ask_left == amount:
+                    del pulled[i]
+                else:
+                    pulled[i][1] -= amount
+            if len(fills) >= limit:
+                break
+            # Bids only get cheaper: once the cheapest remaining ask is out of reach, nothing else fills
+            if pulled:
+                if pulled[0][0]["unit_price"] > bid["unit_price"]:
+                    break
+            elif bid_left:
+                break
+        return fills
+
+    def summary(self, depth: int) -> dict:
+        best_bid = self.best(BUY)
+        best_ask = self.best(SELL)
+        counts = {BUY: 0, SELL: 0}
+        for order in self.orders.values():
+            counts[order[0]] += 1
+        return {
+            "best_bid": best_bid,
+            "best_ask": best_ask,
+            "spread": best_ask["unit_price"] - best_bid["unit_price"] if best_bid and best_ask else None,
+            "bids": {"orders": counts[BUY], "amount": self.volume[BUY], "top": self.top(BUY, depth)},
+            "asks": {"orders": counts[SELL], "amount": self.volume[SELL], "top": self.top(SELL, depth)},
+        }
+
+
+def unit_price(price: float, amount: int) -> float:
+    """Order prices are lot totals; books compare the price of 1kk"""
+    return round(price * UNIT / amount, 4) if amount else price
+
+
+def created_ms(order: dict) -> int:
+    created_at = order.get("created_at")
+    return int(created_at.timestamp() * 1000) if isinstance(created_at, datetime) else 0
+
+
+class OrderBooks:
+    """All books keyed by (project, server_name)"""
+
+    def __init__(self, max_age_ms: Optional[int] = None):
+        self.books: Dict[Tuple[str, str], OrderBook] = {}
+        self.where: Dict[str, Tuple[str, str]] = {}  # order_id -> book key of every live order
+        self.seq = itertools.count()
+        self.max_age_ms = max_age_ms
+        # (created ms, seq, key, order_id) of every add, oldest first; stale entries are skipped
+        self.expiry: List[tuple] = []
+        self.dirty = False
+        # Writes seen while a rebuild reads Mongo, replayed on top of its result
+        self.journal: Optional[List[tuple]] = None
+
+    def book(self, project: str, server_name: str) -> Optional[OrderBook]:
+        return self.books.get((project, server_name))
+
+    def cutoff_ms(self) -> int:
+        """Orders created before this are no longer open"""
+        return int(time.time() * 1000) - self.max_age_ms if self.max_age_ms else 0
+
+    def listed(self, order: Optional[dict]) -> bool:
+        return (
+            order is not None
+            and order.get("status") == "approved"
+            and order.get("order_type") in OPPOSITE
+            and created_ms(order) >= self.cutoff_ms()
+        )
+
+    def sync(self, order: dict) -> bool:
+        """Bring the books in line with one stored order document; returns whether they changed"""
+        order_id = order["id"]
+        if not self.listed(order):
+            return self.discard(order_id)
+        key = (order.get("project"), order.get("server_name"))
+        entry = (
+            order["order_type"], float(order.get("price") or 0), int(order.get("amount") or 0),
+            order.get("user_id"), created_ms(order)
+        )
+        book = self.books.get(self.where.get(order_id))
+        current = book.orders.get(order_id) if book is not None else None
+        # Polls re-read recent orders; unchanged ones keep their place and heap entries
+        if current is not None and self.where[order_id] == key and current[:5] == entry:
+            return False
+        self.discard(order_id)
+        self._add(key, order_id, *entry)
+        self.dirty = True
+        return True
+
+    def discard(self, order_id: str) -> bool:
+        key = self.where.pop(order_id, None)
+        if key is None:
+            return False
+        self.books[key].remove(order_id)
+        self.dirty = True
+        return True
+
+    def _add(self, key: tuple, order_id: str, side: str, price: float, amount: int, user_id, created: int):
+        book = self.books.get(key)
+        if book is None:
+            book = self.books[key] = OrderBook()
+        seq = next(self.seq)
+        book.add(order_id, side, price, amount, user_id, created, seq)
+        self.where[order_id] = key
+        heapq.heappush(self.expiry, (created, seq, key, order_id))
+
+    def apply(self, before: Optional[dict], after: Optional[dict]):
+        """Reflect one order write (before/after are None on create/delete)"""
+        if self.journal is not None:
+            self.journal.append((before, after))
+        if after is not None:
+            self.sync(after)
+        elif before is not None:
+            self.discard(before["id"])
+
+    def expire(self) -> int:
+        """Drop orders that aged out of the window; returns how many left the books"""
+        cutoff = self.cutoff_ms()
+        expired = 0
+        while self.expiry and self.expiry[0][0] < cutoff:
+            _, seq, key, order_id = heapq.heappop(self.expiry)
+            book = self.books.get(key)
+            order = book.orders.get(order_id) if book is not None else None
+            if order is not None and order[5] == seq:
+                self.discard(order_id)
+                expired += 1
+        live = sum(len(book.orders) for book in self.books.values())
+        if len(self.expiry) > 2 * live + COMPACT_SLACK:
+            self.expiry = [
+                (order[4], order[5], key, order_id)
+                for key, book in self.books.items() for order_id, order in book.orders.items()
+            ]
+            heapq.heapify(self.expiry)
+        if expired:
+            self.dirty = True
+        return expired
+
+    def begin_rebuild(self):
+        self.journal = []
+
+    def load(self, orders: List[dict]):
+        """Replace every book with the given orders, then replay writes journaled since begin_rebuild()"""
+        journal, self.journal = self.journal or [], None
+        self.books = {}
+        self.where = {}
+        self.expiry = []
+        for order in orders:
+            self.sync(order)
+        for before, after in journal:
+            self.apply(before, after)
+        self.dirty = True
+
+    # ---------- snapshots ----------
+
+    def dump(self) -> dict:
+        """Plain snapshot of all live orders (cheap enough to take on the event loop)"""
+        rows = []
+        for (project, server_name), book in self.books.items():
+            for order_id, (side, price, amount, user_id, created, _, _) in book.orders.items():
+                rows.append([order_id, project, server_name, side, price, amount, user_id, created])
+        self.dirty = False
+        return {"version": SNAPSHOT_VERSION, "saved_at": int(time.time() * 1000), "orders": rows}
+
+    def restore(self, snapshot: dict) -> int:
+        if snapshot.get("version") != SNAPSHOT_VERSION:
+            return 0
+        self.books = {}
+        self.where = {}
+        self.expiry = []
+        for order_id, project, server_name, side, price, amount, user_id, created in snapshot["orders"]:
+            self._add((project, server_name), order_id, side, price, amount, user_id, created)
+        # Orders that aged out while no worker was running
+        self.expire()
+        return len(snapshot["orders"])
+
+
+def write_snapshot(path: str, snapshot: dict):
+    """Write atomically: readers see the old file or the new one, never half of it"""
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(snapshot, f, separators=(",", ":"))
+    os.replace(tmp, path)
+
+
+class SnapshotWriter:
+    """Only the process holding the lock file writes snapshots; other workers just read them"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock_file = None
+
+    def try_lead(self) -> bool:
+        if self.lock_file is None:
+            self.lock_file = open(self.path + ".lock", "a+b")
+            try:
+                fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Retried on the next write, so a worker takes over when the leader exits
+                self.lock_file.close()
+                self.lock_file = None
+                return False
+        return True
+
+    def write(self, snapshot: dict) -> bool:
+        if not self.try_lead():
+            return False
+        write_snapshot(self.path, snapshot)
+        return True
+
+    def close(self):
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+
+def read_snapshot(path: str) -> Optional[dict]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
@@ -45,6 +45,7 @@ db.exec(`
     refund_enabled INTEGER DEFAULT 1,
     status TEXT DEFAULT 'pending' CHECK(status IN ('pending', 'approved', 'rejected', 'completed')),
     source TEXT DEFAULT 'webapp',
+    idempotency_key TEXT,
     created_at TEXT DEFAULT (datetime('now')),
     updated_at TEXT DEFAULT (datetime('now'))
   );
@@ -61,6 +62,14 @@ db.exec(`
   );
 `);
 
+// Migration: idempotency_key column for databases created before it existed
+const orderColumns = db.prepare(`PRAGMA table_info(orders)`).all().map(c => c.name);
+if (!orderColumns.includes('idempotency_key')) {
+  db.exec(`ALTER TABLE orders ADD COLUMN idempotency_key TEXT`);
+}
+// NULL keys are not considered equal, so orders created without a key are unaffected
+db.exec(`CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_idempotency_key ON orders(idempotency_key)`);
+
 console.log('✅ SQLite database initialized:', DB_PATH);
 
 // ==========================================
@@ -68,14 +77,16 @@ console.log('✅ SQLite database initialized:', DB_PATH);
 // ==========================================
 const stmts = {
   insertOrder: db.prepare(`
-    INSERT INTO orders (id, order_type, project, server_name, server_id, user_id, username, amount, price, contact, refund_enabled, status, source, created_at, updated_at)
-    VALUES (@id, @order_type, @project, @server_name, @server_id, @user_id, @username, @amount, @price, @contact, @refund_enabled, @status, @source, @created_at, @updated_at)
+    INSERT INTO orders (id, order_type, project, server_name, server_id, user_id, username, amount, price, contact, refund_enabled, status, source, idempotency_key, created_at, updated_at)
+    VALUES (@id, @order_type, @project, @server_name, @server_id, @user_id, @username, @amount, @price, @contact, @refund_enabled, @status, @source, @idempotency_key, @created_at, @updated_at)
   `),
 
   getAllOrders: db.prepare(`SELECT * FROM orders ORDER BY created_at DESC`),
 
   getOrderById: db.prepare(`SELECT * FROM orders WHERE id = ?`),
 
+  getOrderByIdempotencyKey: db.prepare(`SELECT * FROM orders WHERE idempotency_key = ?`),
+
   getOrdersByUserId: db.prepare(`SELECT * FROM orders WHERE user_id = ? ORDER BY created_at DESC`),
 
   getOrdersByType: db.prepare(`SELECT * FROM orders WHERE order_type = ? ORDER BY created_at DESC`),
@@ -280,7 +291,7 @@ app.get('/api/orders', (req, res) => {
 // POST /api/orders - Create a new order
 app.post('/api/orders', (req, res) => {
   try {
-    const { order_type, server_name, server_id, user_id, username, amount, price, contact, refund_enabled, source } = req.body;
+    const { order_type, server_name, server_id, user_id, username, amount, price, contact, refund_enabled, source, idempotency_key } = req.body;
 
     // Validation
     if (!user_id) {
@@ -293,6 +304,20 @@ app.post('/api/orders', (req, res) => {
       return sendError(res, 400, 'INVALID_AMOUNT', 'Amount must be at least 100,000');
     }
 
+    // Idempotent replay: the same key always returns the order it created first
+    if (idempotency_key) {
+      const existing = stmts.getOrderByIdempotencyKey.get(idempotency_key);
+      if (existing) {
+        console.log(`[ORDER DUPLICATE] ID: ${existing.id}, Key: ${idempotency_key.slice(0, 12)}`);
+        return res.json({
+          success: true,
+          duplicate: true,
+          ...existing,
+          refund_enabled: Boolean(existing.refund_enabled)
+        });
+      }
+    }
+
     const orderId = uuidv4();
     const now = new Date().toISOString();
 
@@ -310,6 +335,7 @@ app.post('/api/orders', (req, res) => {
       refund_enabled: refund_enabled !== false ? 1 : 0,
       status: order_type === 'buy' ? 'approved' : 'pending',
       source: source || 'webapp',
+      idempotency_key: idempotency_key || null,
       created_at: now,
       updated_at: now
     };
@@ -1,26 +1,197 @@
-from fastapi import FastAPI, APIRouter, HTTPException
+from fastapi import FastAPI, APIRouter, Header, HTTPException, Query, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, ORJSONResponse, PlainTextResponse, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.middleware.gzip import GZipMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, monitoring
+from pymongo.errors import BulkWriteError, CollectionInvalid, DuplicateKeyError, OperationFailure
+import asyncio
+import base64
+import bisect
+import csv
+import hashlib
+import html
+import io
+import json
 import os
 import logging
+import tempfile
+import threading
+import time
+from collections import deque
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Optional
+from typing import List, Literal, Optional
+import urllib.error
+import urllib.request
 import uuid
+import zlib
+from contextlib import asynccontextmanager
 from datetime import datetime, timezone, timedelta
 
+from ban_table import SharedBanTable, TableUnavailable, to_table_id
+from order_book import UNIT, OrderBooks, SnapshotWriter, created_ms, read_snapshot, unit_price
+
+try:
+    import orjson
+except ImportError:  # Falls back to the standard JSON encoder
+    orjson = None
+
+try:
+    from brotli_asgi import BrotliMiddleware
+except ImportError:  # Falls back to gzip-only compression
+    BrotliMiddleware = None
+
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+def env_ms(name: str, default: Optional[int]) -> Optional[int]:
+    """Read a millisecond timeout; empty or 0 means no timeout"""
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return int(value) or None
+
+# Connection pool settings (pymongo defaults unless overridden)
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', '100'))
+MONGO_MIN_POOL_SIZE = int(os.environ.get('MONGO_MIN_POOL_SIZE', '0'))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = env_ms('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000)
+MONGO_CONNECT_TIMEOUT_MS = env_ms('MONGO_CONNECT_TIMEOUT_MS', 10000)
+MONGO_SOCKET_TIMEOUT_MS = env_ms('MONGO_SOCKET_TIMEOUT_MS', None)
+MONGO_WAIT_QUEUE_TIMEOUT_MS = env_ms('MONGO_WAIT_QUEUE_TIMEOUT_MS', None)
+READY_PING_TIMEOUT = float(os.environ.get('READY_PING_TIMEOUT', '2'))
+
+class PoolMonitor(monitoring.ConnectionPoolListener):
+    """Tracks connection checkouts so pool saturation is visible"""
+
+    SAMPLES = 1000
+
+    def __init__(self):
+        # Events arrive from pymongo's worker threads
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.waits = deque(maxlen=self.SAMPLES)
+        self.in_use = 0
+        self.open = 0
+        self.checkouts = 0
+        self.failed_checkouts = 0
+        self.cleared = 0
+
+    def _wait(self, event) -> float:
+        # Older pymongo versions don't report the checkout duration
+        duration = getattr(event, "duration", None)
+        if duration is None:
+            started = getattr(self.local, "started", None)
+            duration = time.perf_counter() - started if started else 0.0
+        return duration
+
+    def connection_check_out_started(self, event):
+        self.local.started = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        wait = self._wait(event)
+        with self.lock:
+            self.in_use += 1
+            self.checkouts += 1
+            self.waits.append(wait)
+
+    def connection_check_out_failed(self, event):
+        wait = self._wait(event)
+        with self.lock:
+            self.failed_checkouts += 1
+            self.waits.append(wait)
+
+    def connection_checked_in(self, event):
+        with self.lock:
+            self.in_use = max(self.in_use - 1, 0)
+
+    def connection_created(self, event):
+        with self.lock:
+            self.open += 1
+
+    def connection_closed(self, event):
+        with self.lock:
+            self.open = max(self.open - 1, 0)
+
+    def connection_ready(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        with self.lock:
+            self.cleared += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            waits = sorted(self.waits)
+            stats = {
+                "max_size": MONGO_MAX_POOL_SIZE,
+                "min_size": MONGO_MIN_POOL_SIZE,
+                "open": self.open,
+                "in_use": self.in_use,
+                "checkouts": self.checkouts,
+                "failed_checkouts": self.failed_checkouts,
+                "cleared": self.cleared,
+            }
+        if waits:
+            stats["wait_ms"] = {
+                "p50": round(waits[len(waits) // 2] * 1000, 3),
+                "p99": round(waits[min(int(len(waits) * 0.99), len(waits) - 1)] * 1000, 3),
+                "max": round(waits[-1] * 1000, 3),
+            }
+        return stats
+
+pool_monitor = PoolMonitor()
+
+# MongoDB connection: created per worker in the lifespan handler (after fork)
+client: Optional[AsyncIOMotorClient] = None
+db = None
+
+def connect_mongo():
+    """Create the Motor client unless one was already set (tests, benchmarks)"""
+    global client, db
+    if client is None:
+        client = AsyncIOMotorClient(
+            os.environ['MONGO_URL'],
+            tz_aware=True,
+            maxPoolSize=MONGO_MAX_POOL_SIZE,
+            minPoolSize=MONGO_MIN_POOL_SIZE,
+            serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+            connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+            socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+            waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+            event_listeners=[pool_monitor, mongo_metrics],
+        )
+    if db is None:
+        db = client[os.environ['DB_NAME']]
+
+# Responses smaller than this are sent uncompressed
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', '1000'))
+COMPRESSION_LEVEL = int(os.environ.get('COMPRESSION_LEVEL', '6'))
+
+DefaultResponse = ORJSONResponse if orjson else JSONResponse
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await startup()
+    try:
+        yield
+    finally:
+        await shutdown()
 
 # Create the main app without a prefix
-app = FastAPI()
+app = FastAPI(default_response_class=DefaultResponse, lifespan=lifespan)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
@@ -57,61 +228,883 @@ class BanUserRequest(BaseModel):
     days: Optional[int] = None  # None = permanent, number = days until unban
     banned_by: str = "admin"
 
+# Upper bound for a single bulk ban check
+MAX_BAN_CHECK_IDS = 1000
+
+class BanCheckRequest(BaseModel):
+    user_ids: List[str] = Field(..., max_length=MAX_BAN_CHECK_IDS)
+
+# ==========================================
+# ORDERS MODELS
+# ==========================================
+
+OrderType = Literal["buy", "sell"]
+OrderStatus = Literal["pending", "approved", "rejected", "completed"]
+
+# Smallest order accepted, in game currency
+MIN_ORDER_AMOUNT = 100_000
+# Seconds an idempotency key keeps returning its order; matches the bot's ORDER_DEDUP_TTL
+IDEMPOTENCY_KEY_TTL = int(os.environ.get('IDEMPOTENCY_KEY_TTL', '600'))
+
+class Order(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    order_type: OrderType = "buy"
+    project: str = "GTA5RP"
+    server_name: str = ""
+    server_id: int = 0
+    user_id: int
+    username: str = ""
+    amount: int
+    price: float = 0
+    contact: str = ""
+    refund_enabled: bool = True
+    status: OrderStatus = "pending"
+    source: str = "webapp"
+    idempotency_key: Optional[str] = None  # Repeated creates with the same key within IDEMPOTENCY_KEY_TTL return the first order
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class OrderCreate(BaseModel):
+    order_type: OrderType = "buy"
+    project: str = "GTA5RP"
+    server_name: Optional[str] = None
+    server_id: Optional[int] = None
+    user_id: Optional[int] = None
+    username: Optional[str] = None
+    amount: Optional[int] = None
+    price: float = 0
+    contact: str = ""
+    refund_enabled: bool = True
+    source: str = "webapp"
+    idempotency_key: Optional[str] = None
+
+class OrderFill(BaseModel):
+    buy_order_id: str
+    sell_order_id: str
+
+class OrderUpdate(BaseModel):
+    amount: Optional[int] = None
+    price: Optional[float] = None
+    contact: Optional[str] = None
+    status: Optional[OrderStatus] = None
+
+def active_ban_filter(now: datetime) -> dict:
+    """Query for bans that are permanent or not yet expired"""
+    # The TTL monitor runs about once a minute, so reads still filter on banned_until
+    return {"$or": [{"banned_until": None}, {"banned_until": {"$gt": now}}]}
+
+def epoch_ms(value: Optional[datetime]) -> int:
+    """Ban expiry in compact form: ms since the epoch, 0 = permanent"""
+    return int(value.timestamp() * 1000) if value else 0
+
+# ==========================================
+# LISTING HELPERS
+# ==========================================
+
+# Largest page returned by JSON listings; NDJSON streams are unbounded unless limit is given
+MAX_PAGE_SIZE = 1000
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+def encode_cursor(*values) -> str:
+    """Opaque keyset cursor built from the sort key of the last returned row"""
+    raw = json.dumps([v.isoformat() if isinstance(v, datetime) else v for v in values])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str, size: int) -> list:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        values = None
+    if not isinstance(values, list) or len(values) != size:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+def decode_time_cursor(cursor: str) -> tuple:
+    """(datetime, id) cursor; anything tampered with is a 400, never a 500 or a query operator"""
+    timestamp, last_id = decode_cursor(cursor, 2)
+    try:
+        if not isinstance(timestamp, str) or not isinstance(last_id, str):
+            raise ValueError(cursor)
+        return datetime.fromisoformat(timestamp), last_id
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def json_response(content, headers: Optional[dict] = None) -> Response:
+    """Render plain documents directly, skipping FastAPI's jsonable_encoder pass when orjson is available"""
+    if orjson:
+        return ORJSONResponse(content, headers=headers)
+    return JSONResponse(jsonable_encoder(content), headers=headers)
+
+async def ndjson_stream(cursor):
+    """Yield one JSON line per document straight from the Motor cursor"""
+    async for doc in cursor:
+        if orjson:
+            yield orjson.dumps(doc, option=orjson.OPT_APPEND_NEWLINE)
+        else:
+            yield json.dumps(doc, default=json_default) + "\n"
+
+def ndjson_response(cursor) -> StreamingResponse:
+    return StreamingResponse(
+        ndjson_stream(cursor),
+        media_type=NDJSON_MEDIA_TYPE,
+        # The gzip middleware doesn't flush per chunk, so rows would sit in its compressor
+        # until enough arrive; an encoding already set makes gzip/brotli pass the body through
+        headers={"Content-Encoding": "identity"},
+    )
+
+# ==========================================
+# CONDITIONAL GET
+# ==========================================
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """True if the client's If-None-Match already covers this ETag"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    return header.strip() == "*" or etag in (tag.strip() for tag in header.split(","))
+
+async def get_resource_version(name: str) -> int:
+    doc = await db.resource_versions.find_one({"_id": name})
+    return doc["version"] if doc else 0
+
+async def bump_resource_version(name: str):
+    """Invalidate cached representations of a resource in every worker"""
+    await db.resource_versions.update_one({"_id": name}, {"$inc": {"version": 1}}, upsert=True)
+
+# ==========================================
+# METRICS
+# ==========================================
+
+# Histogram buckets in seconds (Prometheus defaults)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, labels: str) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+def label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class RequestMetrics:
+    """HTTP request counters and latency histograms keyed by route template"""
+
+    def __init__(self):
+        self.in_flight = 0
+        self.requests = {}
+        self.latency = {}
+
+    def observe(self, method: str, route: str, status: int, seconds: float):
+        key = (method, route, status)
+        self.requests[key] = self.requests.get(key, 0) + 1
+        histogram = self.latency.get((method, route))
+        if histogram is None:
+            histogram = self.latency[(method, route)] = Histogram()
+        histogram.observe(seconds)
+
+    def render(self) -> List[str]:
+        lines = [
+            "# HELP http_requests_in_flight Requests currently being processed",
+            "# TYPE http_requests_in_flight gauge",
+            f"http_requests_in_flight {self.in_flight}",
+            "# HELP http_requests_total Completed requests",
+            "# TYPE http_requests_total counter",
+        ]
+        for (method, route, status), count in sorted(self.requests.items()):
+            lines.append(
+                f'http_requests_total{{method="{method}",route="{label_value(route)}",status="{status}"}} {count}'
+            )
+        lines += [
+            "# HELP http_request_duration_seconds Request latency",
+            "# TYPE http_request_duration_seconds histogram",
+        ]
+        for (method, route), histogram in sorted(self.latency.items()):
+            lines += histogram.render(
+                "http_request_duration_seconds", f'method="{method}",route="{label_value(route)}"'
+            )
+        return lines
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Per-command MongoDB timings from pymongo command monitoring"""
+
+    def __init__(self):
+        # Events arrive from pymongo's worker threads
+        self.lock = threading.Lock()
+        self.latency = {}
+        self.failures = {}
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        with self.lock:
+            histogram = self.latency.get(event.command_name)
+            if histogram is None:
+                histogram = self.latency[event.command_name] = Histogram()
+            histogram.observe(event.duration_micros / 1_000_000)
+
+    def failed(self, event):
+        with self.lock:
+            self.failures[event.command_name] = self.failures.get(event.command_name, 0) + 1
+
+    def render(self) -> List[str]:
+        lines = [
+            "# HELP mongodb_command_duration_seconds MongoDB command latency",
+            "# TYPE mongodb_command_duration_seconds histogram",
+        ]
+        with self.lock:
+            for command, histogram in sorted(self.latency.items()):
+                lines += histogram.render("mongodb_command_duration_seconds", f'command="{command}"')
+            lines += [
+                "# HELP mongodb_command_failures_total Failed MongoDB commands",
+                "# TYPE mongodb_command_failures_total counter",
+            ]
+            for command, count in sorted(self.failures.items()):
+                lines.append(f'mongodb_command_failures_total{{command="{command}"}} {count}')
+        return lines
+
+request_metrics = RequestMetrics()
+mongo_metrics = MongoCommandMetrics()
+
+class MetricsMiddleware:
+    """Pure ASGI middleware: in-flight gauge and per-route latency"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        request_metrics.in_flight += 1
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_metrics.in_flight -= 1
+            # The router stores the matched route; templates keep label cardinality low
+            route = scope.get("route")
+            request_metrics.observe(
+                scope["method"],
+                getattr(route, "path", "unmatched"),
+                status,
+                time.perf_counter() - started
+            )
+
+def render_metrics() -> str:
+    pool = pool_monitor.snapshot()
+    lines = request_metrics.render() + mongo_metrics.render() + [
+        "# HELP mongodb_pool_connections_in_use Connections checked out of the pool",
+        "# TYPE mongodb_pool_connections_in_use gauge",
+        f"mongodb_pool_connections_in_use {pool['in_use']}",
+        "# HELP mongodb_pool_connections_open Open pool connections",
+        "# TYPE mongodb_pool_connections_open gauge",
+        f"mongodb_pool_connections_open {pool['open']}",
+    ]
+    return "\n".join(lines) + "\n"
+
+# ==========================================
+# STATUS WRITE BUFFER
+# ==========================================
+
+# Coalescing window for single status inserts; 0 disables the buffer
+STATUS_WRITE_BUFFER_MS = float(os.environ.get('STATUS_WRITE_BUFFER_MS', '0'))
+STATUS_WRITE_BUFFER_MAX = int(os.environ.get('STATUS_WRITE_BUFFER_MAX', '500'))
+MAX_BULK_STATUS_CHECKS = 1000
+
+class StatusWriteBuffer:
+    """Coalesces single status inserts arriving within a short window into one insert_many"""
+
+    def __init__(self, window_ms: float, max_batch: int):
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.pending = []  # (document, future) pairs waiting for the next flush
+        self.timer = None
+        self.writes = set()  # Batches being written
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
+
+    async def add(self, doc: dict):
+        """Queue a document and wait until the batch containing it is written"""
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((doc, future))
+        if len(self.pending) >= self.max_batch:
+            await self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.create_task(self._flush_later())
+        await future
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        self.timer = None
+        await self.flush()
+
+    async def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        # The write outlives a cancelled caller: the other requests in the batch wait on it
+        write = asyncio.create_task(self._write(batch))
+        self.writes.add(write)
+        write.add_done_callback(self.writes.discard)
+        await asyncio.shield(write)
+
+    async def _write(self, batch: list):
+        failed = {}
+        try:
+            await db.status_checks.insert_many([doc for doc, _ in batch], ordered=False)
+        except BulkWriteError as e:
+            failed = {error["index"]: error.get("errmsg", "write failed") for error in e.details.get("writeErrors", [])}
+        except Exception as e:
+            failed = {index: str(e) for index in range(len(batch))}
+        
+        for index, (_, future) in enumerate(batch):
+            if future.done():
+                continue
+            if index in failed:
+                future.set_exception(RuntimeError(failed[index]))
+            else:
+                future.set_result(None)
+
+    async def close(self):
+        """Write whatever is still buffered (called on shutdown)"""
+        await self.flush()
+        if self.writes:
+            await asyncio.gather(*self.writes, return_exceptions=True)
+
+status_buffer = StatusWriteBuffer(STATUS_WRITE_BUFFER_MS, STATUS_WRITE_BUFFER_MAX)
+
+# ==========================================
+# AUDIT LOG
+# ==========================================
+
+AUDIT_FLUSH_MS = float(os.environ.get('AUDIT_FLUSH_MS', '500'))
+AUDIT_BUFFER_MAX = int(os.environ.get('AUDIT_BUFFER_MAX', '10000'))
+AUDIT_BATCH_MAX = 1000
+# Capped collection: the oldest entries are dropped once the log reaches this size
+AUDIT_LOG_SIZE_BYTES = int(os.environ.get('AUDIT_LOG_SIZE_BYTES', str(256 * 1024 * 1024)))
+
+class AuditLog:
+    """Admin actions buffered in memory and written in batches off the request path"""
+
+    def __init__(self, flush_ms: float, max_buffered: int):
+        self.interval = flush_ms / 1000
+        self.max_buffered = max_buffered
+        self.pending = deque()
+        self.dropped = 0
+        self.task = None
+
+    def record(self, action: str, target: str, actor: Optional[str], **details):
+        """Queue an entry; never waits on Mongo"""
+        if len(self.pending) >= self.max_buffered:
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                logger.error(f"Audit buffer full, {self.dropped} entries dropped so far")
+            return
+        self.pending.append({
+            "id": str(uuid.uuid4()),
+            "ts": datetime.now(timezone.utc),
+            "actor": actor or "unknown",
+            "action": action,
+            "target": str(target),
+            "details": details,
+        })
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def flush(self):
+        while self.pending:
+            batch = [self.pending.popleft() for _ in range(min(len(self.pending), AUDIT_BATCH_MAX))]
+            try:
+                await db.audit_log.insert_many(batch, ordered=False)
+            except Exception as e:
+                logger.error(f"Error writing {len(batch)} audit entries: {e}")
+                # Keep them for the next flush while there is room
+                room = self.max_buffered - len(self.pending)
+                self.pending.extendleft(reversed(batch[:max(room, 0)]))
+                return
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.flush()
+
+audit_log = AuditLog(AUDIT_FLUSH_MS, AUDIT_BUFFER_MAX)
+
+async def create_audit_log():
+    """Create the capped audit collection and its query indexes"""
+    try:
+        await db.create_collection("audit_log", capped=True, size=AUDIT_LOG_SIZE_BYTES)
+    except CollectionInvalid:
+        pass  # Already exists
+    except Exception as e:
+        logger.error(f"Error creating audit log collection: {e}")
+    try:
+        await asyncio.gather(
+            db.audit_log.create_index([("ts", -1), ("id", -1)]),
+            db.audit_log.create_index([("actor", 1), ("ts", -1)]),
+            db.audit_log.create_index([("target", 1), ("ts", -1)]),
+        )
+    except Exception as e:
+        logger.error(f"Error creating audit log indexes: {e}")
+
+# ==========================================
+# IN-MEMORY BAN SNAPSHOT
+# ==========================================
+
+# "auto" uses a change stream and falls back to polling on standalone mongod, "poll" always polls
+BAN_CACHE_SYNC = os.environ.get('BAN_CACHE_SYNC', 'auto')
+BAN_CACHE_POLL_SECONDS = float(os.environ.get('BAN_CACHE_POLL_SECONDS', '5'))
+# "shm": with several workers, one leader publishes bans to a memory-mapped table for all of them
+BAN_STORE = os.environ.get('BAN_STORE', 'memory')
+BAN_SHM_PATH = os.environ.get(
+    'BAN_SHM_PATH',
+    os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), 'telergroum-bans')
+)
+
+# "The $changeStream stage is only supported on replica sets"
+CHANGE_STREAM_UNSUPPORTED = 40573
+
+class BanCache:
+    """In-process copy of active bans, kept in sync by a change stream or polling"""
+
+    def __init__(self):
+        self.bans = {}  # user_id -> {"banned_until": ..., "username": ...}
+        self.ids = {}  # Mongo _id -> user_id, delete events only carry the _id
+        self.loaded = False
+        self.task = None
+        self.publisher = None  # SharedBanTable when this worker leads in shm mode
+        self.version = 0  # Bumped on every change applied to the snapshot
+        self._etag = None
+        self._etag_version = -1
+        self._etag_valid_until = None
+
+    async def load(self):
+        """Replace the snapshot with the active bans currently in Mongo"""
+        query = active_ban_filter(datetime.now(timezone.utc))
+        projection = {"_id": 1, "user_id": 1, "banned_until": 1, "banned_at": 1, "username": 1}
+        docs = await db.banned_users.find(query, projection).to_list(None)
+        bans = {doc["user_id"]: self._entry(doc) for doc in docs}
+        changed = bans != self.bans
+        self.bans = bans
+        self.ids = {doc["_id"]: doc["user_id"] for doc in docs}
+        self.loaded = True
+        if changed:
+            self._changed()
+
+    def _changed(self):
+        self.version += 1
+        if self.publisher is not None:
+            self.publish()
+
+    def publish(self):
+        """Write the snapshot to the shared table read by the other workers"""
+        entries = []
+        for user_id, ban in self.bans.items():
+            table_id = to_table_id(user_id)
+            if table_id is None:
+                continue
+            entries.append((table_id, epoch_ms(ban["banned_until"])))
+        self.publisher.publish(entries)
+
+    @staticmethod
+    def _entry(doc: dict) -> dict:
+        return {
+            "banned_until": doc.get("banned_until"),
+            "banned_at": doc.get("banned_at"),
+            "username": doc.get("username"),
+        }
+
+    def etag(self, now: datetime) -> str:
+        """Content hash of the active bans, recomputed only after a change or an expiry"""
+        expired = self._etag_valid_until is not None and self._etag_valid_until <= now
+        if self._etag_version != self.version or expired:
+            active = sorted(
+                (user_id, ban["banned_until"], ban["banned_at"], ban["username"])
+                for user_id, ban in self.bans.items()
+                if ban["banned_until"] is None or ban["banned_until"] > now
+            )
+            self._etag = f'W/"bans-{hashlib.sha1(repr(active).encode()).hexdigest()[:16]}"'
+            self._etag_version = self.version
+            self._etag_valid_until = min((ban[1] for ban in active if ban[1] is not None), default=None)
+        return self._etag
+
+    def get(self, user_id: str, now: datetime) -> Optional[dict]:
+        """Active ban for user_id, or None"""
+        ban = self.bans.get(user_id)
+        if ban is None:
+            return None
+        if ban["banned_until"] is not None and ban["banned_until"] <= now:
+            return None
+        return ban
+
+    def put(self, doc: dict, _id=None):
+        self.bans[doc["user_id"]] = self._entry(doc)
+        if _id is not None:
+            self.ids[_id] = doc["user_id"]
+        self._changed()
+
+    def remove(self, user_id: str):
+        if self.bans.pop(user_id, None) is not None:
+            self._changed()
+
+    def apply_change(self, change: dict):
+        """Apply one change stream event to the snapshot"""
+        _id = change["documentKey"]["_id"]
+        if change["operationType"] == "delete":
+            user_id = self.ids.pop(_id, None)
+            if user_id is not None:
+                self.remove(user_id)
+        elif change.get("fullDocument"):
+            self.put(change["fullDocument"], _id)
+
+    def start(self):
+        self.task = asyncio.create_task(self._sync())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def _sync(self):
+        if BAN_CACHE_SYNC == 'poll':
+            await self._poll()
+        while True:
+            try:
+                await self._watch()
+            except asyncio.CancelledError:
+                raise
+            except OperationFailure as e:
+                if e.code == CHANGE_STREAM_UNSUPPORTED:
+                    logger.info(f"Change streams unavailable, polling bans every {BAN_CACHE_POLL_SECONDS}s")
+                    await self._poll()
+                logger.error(f"Ban change stream failed: {e}")
+                await asyncio.sleep(BAN_CACHE_POLL_SECONDS)
+            except Exception as e:
+                logger.error(f"Ban change stream failed: {e}")
+                await asyncio.sleep(BAN_CACHE_POLL_SECONDS)
+
+    async def _watch(self):
+        pipeline = [{"$match": {"operationType": {"$in": ["insert", "update", "replace", "delete"]}}}]
+        async with db.banned_users.watch(pipeline, full_document="updateLookup") as stream:
+            # Reload once the stream is open so no change between load and watch is lost
+            await self.load()
+            async for change in stream:
+                self.apply_change(change)
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(BAN_CACHE_POLL_SECONDS)
+            try:
+                await self.load()
+            except Exception as e:
+                logger.error(f"Error reloading ban snapshot: {e}")
+
+ban_cache = BanCache()
+
+# How long ban changes stay in the log for incremental snapshot clients
+BAN_CHANGES_RETENTION = int(os.environ.get('BAN_CHANGES_RETENTION', str(7 * 24 * 3600)))
+# A version missing from the log for this long was never written: clients get a full snapshot
+BAN_CHANGES_GAP_SECONDS = float(os.environ.get('BAN_CHANGES_GAP_SECONDS', '30'))
+
+async def record_ban_change(user_id: str, banned: bool, banned_until: Optional[datetime] = None):
+    """Append a ban/unban to the versioned change log"""
+    try:
+        counter = await db.resource_versions.find_one_and_update(
+            {"_id": "bans"},
+            # updated_at dates the newest version, even when its change row never lands
+            {"$inc": {"version": 1}, "$set": {"updated_at": datetime.now(timezone.utc)}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        await db.ban_changes.insert_one({
+            "version": counter["version"],
+            "user_id": user_id,
+            "banned": banned,
+            "banned_until": banned_until,
+            "ts": datetime.now(timezone.utc),
+        })
+    except Exception as e:
+        # Clients fall back to a full snapshot periodically, so a lost entry heals itself
+        logger.error(f"Error recording ban change for {user_id}: {e}")
+
+# Set in shm mode; followers read it, the leader's ban_cache writes it
+shared_bans: Optional[SharedBanTable] = None
+
+def shared_ban_state(user_id: str, now: datetime):
+    """(banned, banned_until) from the shared table, or None if it can't answer"""
+    table_id = to_table_id(user_id)
+    if shared_bans is None or table_id is None:
+        return None
+    try:
+        expires_ms = shared_bans.lookup(table_id)
+    except TableUnavailable:
+        return None
+    if expires_ms is None:
+        return False, None
+    if expires_ms == 0:
+        return True, None
+    banned_until = datetime.fromtimestamp(expires_ms / 1000, timezone.utc)
+    return (True, banned_until) if banned_until > now else (False, None)
+
+async def follow_ban_leader():
+    """Follower loop: take over publishing if the leader process goes away"""
+    while not shared_bans.try_lead():
+        await asyncio.sleep(BAN_CACHE_POLL_SECONDS)
+    logger.info(f"Worker {os.getpid()} took over the shared ban table")
+    ban_cache.publisher = shared_bans
+    try:
+        await ban_cache.load()
+        ban_cache.publish()
+    except Exception as e:
+        logger.error(f"Error loading ban snapshot: {e}")
+    await ban_cache._sync()
+
 # Add your routes to the router instead of directly to app
 @api_router.get("/")
 async def root():
     return {"message": "Hello World"}
 
+@api_router.get("/health/ready")
+async def readiness():
+    """Readiness probe: MongoDB ping plus connection pool usage"""
+    started = time.perf_counter()
+    try:
+        await asyncio.wait_for(db.command("ping"), timeout=READY_PING_TIMEOUT)
+        status, code = "ready", 200
+    except Exception as e:
+        logger.error(f"Readiness ping failed: {e}")
+        status, code = "unavailable", 503
+    return DefaultResponse(status_code=code, content={
+        "status": status,
+        "mongo_ping_ms": round((time.perf_counter() - started) * 1000, 3),
+        "pool": pool_monitor.snapshot(),
+        "startup_ms": STARTUP_TIMINGS,
+    })
+
 @api_router.post("/status", response_model=StatusCheck)
 async def create_status_check(input: StatusCheckCreate):
     status_dict = input.model_dump()
     status_obj = StatusCheck(**status_dict)
     
-    # Convert to dict and serialize datetime to ISO string for MongoDB
+    # timestamp is stored as a native BSON datetime
     doc = status_obj.model_dump()
-    doc['timestamp'] = doc['timestamp'].isoformat()
-    
-    _ = await db.status_checks.insert_one(doc)
+    if status_buffer.enabled:
+        await status_buffer.add(doc)
+    else:
+        _ = await db.status_checks.insert_one(doc)
     return status_obj
 
+@api_router.post("/status/bulk", response_model=List[StatusCheck])
+async def create_status_checks(input: List[StatusCheckCreate]):
+    """Insert a batch of status checks with a single unordered insert_many"""
+    if len(input) > MAX_BULK_STATUS_CHECKS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BULK_STATUS_CHECKS} status checks per request")
+    if not input:
+        return []
+    
+    status_objs = [StatusCheck(**item.model_dump()) for item in input]
+    try:
+        await db.status_checks.insert_many([obj.model_dump() for obj in status_objs], ordered=False)
+    except BulkWriteError as e:
+        failed = {error["index"] for error in e.details.get("writeErrors", [])}
+        logger.error(f"Bulk status insert: {len(failed)} of {len(status_objs)} writes failed")
+        return [obj for index, obj in enumerate(status_objs) if index not in failed]
+    return status_objs
+
 @api_router.get("/status", response_model=List[StatusCheck])
-async def get_status_checks():
+async def get_status_checks(
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    after: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1),
+    fmt: str = Query("json", alias="format", pattern="^(json|ndjson)$"),
+):
+    # Range filtering, keyset pagination and sorting run in Mongo on the (timestamp, id) index
+    conditions = []
+    if since:
+        conditions.append({"timestamp": {"$gte": since}})
+    if until:
+        conditions.append({"timestamp": {"$lt": until}})
+    if after:
+        timestamp, last_id = decode_time_cursor(after)
+        conditions.append({"$or": [
+            {"timestamp": {"$gt": timestamp}},
+            {"timestamp": timestamp, "id": {"$gt": last_id}},
+        ]})
+    query = {"$and": conditions} if conditions else {}
+    
     # Exclude MongoDB's _id field from the query results
-    status_checks = await db.status_checks.find({}, {"_id": 0}).to_list(1000)
+    cursor = db.status_checks.find(query, {"_id": 0}).sort([("timestamp", 1), ("id", 1)])
     
-    # Convert ISO string timestamps back to datetime objects
-    for check in status_checks:
-        if isinstance(check['timestamp'], str):
-            check['timestamp'] = datetime.fromisoformat(check['timestamp'])
+    if fmt == "ndjson":
+        if limit:
+            cursor = cursor.limit(limit)
+        return ndjson_response(cursor)
     
-    return status_checks
+    limit = min(limit or MAX_PAGE_SIZE, MAX_PAGE_SIZE)
+    status_checks = await cursor.limit(limit).to_list(None)
+    headers = {}
+    if len(status_checks) == limit:
+        last = status_checks[-1]
+        headers["X-Next-Cursor"] = encode_cursor(last["timestamp"], last["id"])
+    return json_response(status_checks, headers)
 
 # ==========================================
 # BANNED USERS ENDPOINTS
 # ==========================================
 
+def servable_ban_changes(
+    since_version: int, version: int, changes: List[dict], bumped_at: Optional[datetime], now: datetime
+) -> Optional[List[dict]]:
+    """Gap-free run of changes after since_version, or None if a missing one is lost for good"""
+    # Versions are taken before the insert, so a later change can land first:
+    # hand out only the gap-free prefix and let the client ask again for the rest
+    prefix = 0
+    while prefix < len(changes) and changes[prefix]["version"] == since_version + prefix + 1:
+        prefix += 1
+    if prefix < len(changes):
+        # The missing version was taken before the change that follows it
+        missing_since = changes[prefix]["ts"]
+    elif since_version + prefix < version:
+        # No row after the hole yet: the newest version was taken at the counter's updated_at
+        missing_since = bumped_at
+    else:
+        return changes
+    # A hole older than the grace period is a change that was never written
+    if missing_since is None or missing_since < now - timedelta(seconds=BAN_CHANGES_GAP_SECONDS):
+        return None
+    return changes[:prefix]
+
+def incremental_ban_snapshot(since_version: int, changes: List[dict]) -> Response:
+    # Last change per user wins
+    latest = {change["user_id"]: change for change in changes}
+    banned = []
+    unbanned = []
+    for user_id, change in latest.items():
+        table_id = to_table_id(user_id)
+        if table_id is None:
+            continue
+        if change["banned"]:
+            banned.append([table_id, epoch_ms(change["banned_until"])])
+        else:
+            unbanned.append(table_id)
+    return json_response({
+        "version": changes[-1]["version"] if changes else since_version,
+        "full": False,
+        "banned": banned,
+        "unbanned": unbanned,
+    })
+
+@api_router.get("/banned/snapshot")
+async def get_ban_snapshot(since_version: Optional[int] = Query(None, ge=0)):
+    """Compact ban list for client-side filters: everything, or only the changes after since_version"""
+    try:
+        now = datetime.now(timezone.utc)
+        # Read the version first: anything changed meanwhile is sent again next time
+        counter = await db.resource_versions.find_one({"_id": "bans"})
+        version = counter["version"] if counter else 0
+        if since_version is not None and since_version <= version:
+            oldest = await db.ban_changes.find_one({}, {"version": 1}, sort=[("version", 1)])
+            # Incremental only if no change after since_version has left the log yet
+            if since_version == version or (oldest and oldest["version"] <= since_version + 1):
+                changes = await db.ban_changes.find(
+                    {"version": {"$gt": since_version}},
+                    {"_id": 0, "version": 1, "user_id": 1, "banned": 1, "banned_until": 1, "ts": 1}
+                ).sort("version", 1).to_list(None)
+                bumped_at = counter.get("updated_at") if counter else None
+                changes = servable_ban_changes(since_version, version, changes, bumped_at, now)
+                if changes is not None:
+                    return incremental_ban_snapshot(since_version, changes)
+
+        # From Mongo, not the ban cache: the cache can trail other workers' bans that are
+        # already counted in `version`. Every change up to `version` is in banned_users.
+        docs = await db.banned_users.find(
+            active_ban_filter(now), {"_id": 0, "user_id": 1, "banned_until": 1}
+        ).to_list(None)
+        bans = []
+        for doc in docs:
+            table_id = to_table_id(doc["user_id"])
+            if table_id is not None:
+                bans.append([table_id, epoch_ms(doc.get("banned_until"))])
+        bans.sort()
+        return json_response({"version": version, "full": True, "bans": bans})
+    except Exception as e:
+        logger.error(f"Error building ban snapshot: {e}")
+        raise HTTPException(status_code=500, detail="Failed to build ban snapshot")
+
 @api_router.get("/banned/{user_id}")
 async def check_user_banned(user_id: str):
     """Check if a user is banned"""
     try:
-        # Find ban record for user
-        ban_record = await db.banned_users.find_one({"user_id": user_id}, {"_id": 0})
+        now = datetime.now(timezone.utc)
+        if ban_cache.loaded:
+            ban_record = ban_cache.get(user_id, now)
+        elif shared_ban_state(user_id, now) == (False, None):
+            ban_record = None
+        else:
+            # Ban details (username) are only in Mongo; the shared table answers misses
+            query = {"user_id": user_id, **active_ban_filter(now)}
+            ban_record = await db.banned_users.find_one(query, {"_id": 0})
         
         if not ban_record:
             return {"banned": False}
         
-        # Check if ban has expired
-        if ban_record.get('banned_until'):
-            banned_until = ban_record['banned_until']
-            if isinstance(banned_until, str):
-                banned_until = datetime.fromisoformat(banned_until)
-            
-            # If ban expired, remove it and return not banned
-            if banned_until < datetime.now(timezone.utc):
-                await db.banned_users.delete_one({"user_id": user_id})
-                return {"banned": False}
-        
-        # User is still banned
         return {
             "banned": True,
             "banned_until": ban_record.get('banned_until'),
@@ -121,31 +1114,69 @@ async def check_user_banned(user_id: str):
         logger.error(f"Error checking ban status: {e}")
         return {"banned": False}
 
+@api_router.post("/banned/check")
+async def check_users_banned(request: BanCheckRequest):
+    """Check ban state for many users with a single $in query"""
+    try:
+        user_ids = list(dict.fromkeys(request.user_ids))
+        now = datetime.now(timezone.utc)
+        banned = {}
+        unknown = []
+        if ban_cache.loaded:
+            for user_id in user_ids:
+                ban = ban_cache.get(user_id, now)
+                if ban is not None:
+                    banned[user_id] = ban["banned_until"]
+        else:
+            for user_id in user_ids:
+                state = shared_ban_state(user_id, now)
+                if state is None:
+                    unknown.append(user_id)
+                elif state[0]:
+                    banned[user_id] = state[1]
+        if unknown:
+            query = {"user_id": {"$in": unknown}, **active_ban_filter(now)}
+            projection = {"_id": 0, "user_id": 1, "banned_until": 1}
+            bans = await db.banned_users.find(query, projection).to_list(len(unknown))
+            banned.update((ban["user_id"], ban.get("banned_until")) for ban in bans)
+        return {
+            user_id: {"banned": True, "banned_until": banned[user_id]} if user_id in banned else {"banned": False}
+            for user_id in user_ids
+        }
+    except Exception as e:
+        logger.error(f"Error checking ban status in bulk: {e}")
+        raise HTTPException(status_code=500, detail="Failed to check bans")
+
 @api_router.post("/banned")
-async def ban_user(request: BanUserRequest):
+async def ban_user(request: BanUserRequest, x_actor: Optional[str] = Header(None)):
     """Ban a user (temporary or permanent)"""
     try:
         # Calculate ban expiry if days specified
         banned_until = None
         if request.days:
             banned_until = datetime.now(timezone.utc) + timedelta(days=request.days)
+            # BSON keeps milliseconds only; truncate so the ban snapshot matches Mongo
+            banned_until = banned_until.replace(microsecond=banned_until.microsecond // 1000 * 1000)
         
         # Create ban record
         ban_doc = {
             "id": str(uuid.uuid4()),
             "user_id": request.user_id,
             "username": request.username,
-            "banned_at": datetime.now(timezone.utc).isoformat(),
-            "banned_until": banned_until.isoformat() if banned_until else None,
+            "banned_at": datetime.now(timezone.utc),
+            "banned_until": banned_until,  # expired by the TTL index
             "banned_by": request.banned_by
         }
         
         # Update or insert ban record
-        await db.banned_users.update_one(
+        result = await db.banned_users.update_one(
             {"user_id": request.user_id},
             {"$set": ban_doc},
             upsert=True
         )
+        ban_cache.put(ban_doc, result.upserted_id)
+        await record_ban_change(request.user_id, True, banned_until)
+        audit_log.record("ban", request.user_id, x_actor or request.banned_by, days=request.days)
         
         logger.info(f"User {request.user_id} banned by {request.banned_by}")
         
@@ -159,13 +1190,17 @@ async def ban_user(request: BanUserRequest):
         raise HTTPException(status_code=500, detail="Failed to ban user")
 
 @api_router.delete("/banned/{user_id}")
-async def unban_user(user_id: str):
+async def unban_user(user_id: str, unbanned_by: str = "admin", x_actor: Optional[str] = Header(None)):
     """Unban a user"""
     try:
         result = await db.banned_users.delete_one({"user_id": user_id})
+        ban_cache.remove(user_id)
         
         if result.deleted_count > 0:
-            logger.info(f"User {user_id} unbanned")
+            await record_ban_change(user_id, False)
+            # Same actor resolution as ban_user: the header, else who the caller says it is
+            audit_log.record("unban", user_id, x_actor or unbanned_by)
+            logger.info(f"User {user_id} unbanned by {unbanned_by}")
             return {"success": True, "message": "User unbanned successfully"}
         else:
             return {"success": False, "message": "User was not banned"}
@@ -174,32 +1209,914 @@ async def unban_user(user_id: str):
         raise HTTPException(status_code=500, detail="Failed to unban user")
 
 @api_router.get("/banned")
-async def get_banned_users():
-    """Get list of all banned users"""
+async def get_banned_users(
+    request: Request,
+    after: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1),
+    fmt: str = Query("json", alias="format", pattern="^(json|ndjson)$"),
+):
+    """Get list of all banned users, paginated by user_id"""
+    now = datetime.now(timezone.utc)
+    etag = ban_cache.etag(now) if ban_cache.loaded and fmt == "json" else None
+    if etag and etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    
+    query = active_ban_filter(now)
+    if after:
+        last_user_id, = decode_cursor(after, 1)
+        if not isinstance(last_user_id, str):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query = {"$and": [query, {"user_id": {"$gt": last_user_id}}]}
+    
     try:
-        banned_users = await db.banned_users.find({}, {"_id": 0}).to_list(1000)
+        cursor = db.banned_users.find(query, {"_id": 0}).sort("user_id", 1)
         
-        # Convert ISO strings back to datetime for filtering expired bans
-        current_time = datetime.now(timezone.utc)
-        active_bans = []
+        if fmt == "ndjson":
+            if limit:
+                cursor = cursor.limit(limit)
+            return ndjson_response(cursor)
         
-        for ban in banned_users:
-            if ban.get('banned_until'):
-                banned_until = datetime.fromisoformat(ban['banned_until'])
-                # Remove expired bans
-                if banned_until < current_time:
-                    await db.banned_users.delete_one({"user_id": ban['user_id']})
-                    continue
-            active_bans.append(ban)
-        
-        return active_bans
+        limit = min(limit or MAX_PAGE_SIZE, MAX_PAGE_SIZE)
+        banned_users = await cursor.limit(limit).to_list(None)
+        headers = {}
+        if len(banned_users) == limit:
+            headers["X-Next-Cursor"] = encode_cursor(banned_users[-1]["user_id"])
+        if etag:
+            headers["ETag"] = etag
+        return json_response(banned_users, headers)
     except Exception as e:
         logger.error(f"Error getting banned users: {e}")
         return []
 
+# ==========================================
+# MATERIALIZED SERVER STATS
+# ==========================================
+# server_stats holds one document per (project, order_type, server_name) with the
+# total amount and number of distinct users over approved orders. Distinct users are
+# tracked with per-user refcounts in server_stats_users.
+
+STATS_COUNT_FIELDS = {"sell": "total_sellers", "buy": "total_buyers"}
+
+def stats_key(order: dict) -> dict:
+    return {
+        "project": order.get("project"),
+        "order_type": order.get("order_type"),
+        "server_name": order.get("server_name"),
+    }
+
+async def add_order_to_stats(order: dict, sign: int):
+    """Add (sign=1) or remove (sign=-1) one approved order from the stats"""
+    key = stats_key(order)
+    ref = await db.server_stats_users.find_one_and_update(
+        {**key, "user_id": order["user_id"]},
+        {"$inc": {"orders": sign}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    
+    users_delta = 0
+    if sign > 0 and ref["orders"] == 1:
+        users_delta = 1
+    elif sign < 0 and ref["orders"] <= 0:
+        users_delta = -1
+        # Filter on the count so a concurrent increment is not lost
+        await db.server_stats_users.delete_one({"_id": ref["_id"], "orders": {"$lte": 0}})
+    
+    await db.server_stats.update_one(
+        key,
+        {
+            "$inc": {"total_amount": sign * order.get("amount", 0), "total_users": users_delta},
+            "$set": {"server_id": order.get("server_id", 0)},
+        },
+        upsert=True
+    )
+
+async def apply_order_stats(before: Optional[dict], after: Optional[dict]):
+    """Update server_stats for one order write (before/after are None on create/delete)"""
+    was_approved = before is not None and before.get("status") == "approved"
+    is_approved = after is not None and after.get("status") == "approved"
+    try:
+        same_bucket = (
+            was_approved and is_approved
+            and stats_key(before) == stats_key(after)
+            and before.get("user_id") == after.get("user_id")
+        )
+        if same_bucket:
+            delta = after.get("amount", 0) - before.get("amount", 0)
+            if delta:
+                await db.server_stats.update_one(stats_key(after), {"$inc": {"total_amount": delta}})
+                await bump_resource_version(f"stats:{after.get('project')}")
+            return
+        if was_approved:
+            await add_order_to_stats(before, -1)
+            await bump_resource_version(f"stats:{before.get('project')}")
+        if is_approved:
+            await add_order_to_stats(after, 1)
+            if not was_approved or before.get("project") != after.get("project"):
+                await bump_resource_version(f"stats:{after.get('project')}")
+    except Exception as e:
+        logger.error(f"Error updating server stats: {e}")
+
+async def read_server_stats(project: str, order_type: str) -> list:
+    """Per-server stats in the shape of the old GROUP BY endpoints"""
+    count_field = STATS_COUNT_FIELDS[order_type]
+    query = {"project": project, "order_type": order_type, "total_users": {"$gt": 0}}
+    docs = await db.server_stats.find(query, {"_id": 0}).to_list(None)
+    return [
+        {
+            "server_name": doc["server_name"],
+            "server_id": doc.get("server_id", 0),
+            count_field: doc["total_users"],
+            "total_amount": doc.get("total_amount", 0),
+        }
+        for doc in docs
+    ]
+
+async def create_stats_indexes():
+    await db.server_stats.create_index([("project", 1), ("order_type", 1), ("server_name", 1)], unique=True)
+    await db.server_stats_users.create_index(
+        [("project", 1), ("order_type", 1), ("server_name", 1), ("user_id", 1)],
+        unique=True
+    )
+
+async def rebuild_server_stats() -> int:
+    """Recompute server_stats from approved orders and swap it in; returns the number of servers"""
+    await db.orders.aggregate([
+        {"$match": {"status": "approved"}},
+        {"$group": {
+            "_id": {
+                "project": "$project",
+                "order_type": "$order_type",
+                "server_name": "$server_name",
+                "user_id": "$user_id",
+            },
+            "orders": {"$sum": 1},
+            "amount": {"$sum": "$amount"},
+            "server_id": {"$last": "$server_id"},
+        }},
+        {"$project": {
+            "_id": 0,
+            "project": "$_id.project",
+            "order_type": "$_id.order_type",
+            "server_name": "$_id.server_name",
+            "user_id": "$_id.user_id",
+            "orders": 1,
+            "amount": 1,
+            "server_id": 1,
+        }},
+        {"$out": "server_stats_users_rebuild"},
+    ]).to_list(None)
+    
+    await db.server_stats_users_rebuild.aggregate([
+        {"$group": {
+            "_id": {"project": "$project", "order_type": "$order_type", "server_name": "$server_name"},
+            "total_users": {"$sum": 1},
+            "total_amount": {"$sum": "$amount"},
+            "server_id": {"$last": "$server_id"},
+        }},
+        {"$project": {
+            "_id": 0,
+            "project": "$_id.project",
+            "order_type": "$_id.order_type",
+            "server_name": "$_id.server_name",
+            "server_id": 1,
+            "total_users": 1,
+            "total_amount": 1,
+        }},
+        {"$out": "server_stats_rebuild"},
+    ]).to_list(None)
+    await db.server_stats_users_rebuild.update_many({}, {"$unset": {"amount": "", "server_id": ""}})
+    
+    servers = await db.server_stats_rebuild.count_documents({})
+    if servers:
+        await db.server_stats_users_rebuild.rename("server_stats_users", dropTarget=True)
+        await db.server_stats_rebuild.rename("server_stats", dropTarget=True)
+    else:
+        await db.server_stats_users.delete_many({})
+        await db.server_stats.delete_many({})
+    await create_stats_indexes()
+    
+    # Every project's stats may have changed, including projects that no longer have any
+    await db.resource_versions.update_many({"_id": {"$regex": "^stats:"}}, {"$inc": {"version": 1}})
+    for project in await db.server_stats.distinct("project"):
+        await bump_resource_version(f"stats:{project}")
+    
+    logger.info(f"Rebuilt server stats for {servers} servers")
+    return servers
+
+# ==========================================
+# ORDER BOOK
+# ==========================================
+# Open buy/sell orders per (project, server_name) with price-time priority: approved
+# and younger than ORDER_BOOK_MAX_AGE_HOURS. Filling a match completes or shrinks both orders.
+# Each worker applies its own order writes immediately and follows the other workers'
+# writes through a change stream, or by polling updated_at on standalone mongod. Full
+# rebuilds run at startup and when the stream reconnects; in poll mode also every
+# ORDER_BOOK_REBUILD_SECONDS, since polls can't see deletes. One worker (holding the
+# snapshot lock) writes the snapshot used to serve books before the first rebuild.
+
+ORDER_BOOK_SNAPSHOT_PATH = os.environ.get(
+    'ORDER_BOOK_SNAPSHOT_PATH', os.path.join(tempfile.gettempdir(), 'telergroum-order-book.json')
+)
+ORDER_BOOK_SNAPSHOT_SECONDS = float(os.environ.get('ORDER_BOOK_SNAPSHOT_SECONDS', '60'))
+# "auto" uses a change stream and falls back to polling on standalone mongod, "poll" always polls
+ORDER_BOOK_SYNC = os.environ.get('ORDER_BOOK_SYNC', 'auto')
+ORDER_BOOK_POLL_SECONDS = float(os.environ.get('ORDER_BOOK_POLL_SECONDS', '5'))
+# Polls re-read this far back: a write stamped before the last poll may commit after it
+ORDER_BOOK_POLL_OVERLAP_SECONDS = float(os.environ.get('ORDER_BOOK_POLL_OVERLAP_SECONDS', '10'))
+ORDER_BOOK_REBUILD_SECONDS = float(os.environ.get('ORDER_BOOK_REBUILD_SECONDS', '900'))
+# Orders nobody filled within this window are treated as abandoned and leave the book
+ORDER_BOOK_MAX_AGE_HOURS = float(os.environ.get('ORDER_BOOK_MAX_AGE_HOURS', '72'))
+ORDER_BOOK_EXPIRE_SECONDS = float(os.environ.get('ORDER_BOOK_EXPIRE_SECONDS', '60'))
+ORDER_BOOK_FIELDS = {
+    "_id": 1, "id": 1, "project": 1, "server_name": 1, "order_type": 1,
+    "status": 1, "price": 1, "amount": 1, "user_id": 1, "created_at": 1,
+}
+
+order_books = OrderBooks(max_age_ms=int(ORDER_BOOK_MAX_AGE_HOURS * 3600 * 1000))
+order_book_snapshots = SnapshotWriter(ORDER_BOOK_SNAPSHOT_PATH)
+order_book_ids = {}  # Mongo _id -> order id of listed orders, delete events only carry the _id
+order_book_tasks: List[asyncio.Task] = []
+
+def restore_order_books() -> bool:
+    """Serve the last snapshot until the rebuild from Mongo finishes"""
+    try:
+        snapshot = read_snapshot(ORDER_BOOK_SNAPSHOT_PATH)
+        if snapshot is None:
+            return False
+        restored = order_books.restore(snapshot)
+        logger.info(f"Restored {restored} orders from order book snapshot")
+        return True
+    except Exception as e:
+        logger.error(f"Error restoring order book snapshot: {e}")
+        return False
+
+async def load_order_books() -> datetime:
+    """Reload every book from open orders; writes made meanwhile are replayed. Returns the read time"""
+    started = datetime.now(timezone.utc)
+    order_books.begin_rebuild()
+    cutoff = started - timedelta(hours=ORDER_BOOK_MAX_AGE_HOURS)
+    try:
+        orders = await db.orders.find(
+            {"status": "approved", "order_type": {"$in": ["buy", "sell"]}, "created_at": {"$gte": cutoff}},
+            ORDER_BOOK_FIELDS
+        ).to_list(None)
+    except BaseException:
+        order_books.journal = None
+        raise
+    order_books.load(orders)
+    order_book_ids.clear()
+    order_book_ids.update((order["_id"], order["id"]) for order in orders)
+    logger.debug(f"Order books rebuilt from {len(orders)} open orders")
+    return started
+
+async def rebuild_order_books() -> Optional[datetime]:
+    try:
+        return await load_order_books()
+    except Exception as e:
+        logger.error(f"Error rebuilding order books: {e}")
+        return None
+
+def apply_order_change(change: dict):
+    """Apply one orders change stream event to the books"""
+    _id = change["documentKey"]["_id"]
+    if change["operationType"] == "delete":
+        order_id = order_book_ids.pop(_id, None)
+        if order_id is not None:
+            order_books.discard(order_id)
+        return
+    order = change.get("fullDocument")
+    if not order or "id" not in order:
+        return
+    order_books.sync(order)
+    if order_books.listed(order):
+        order_book_ids[_id] = order["id"]
+    else:
+        order_book_ids.pop(_id, None)
+
+async def watch_order_books():
+    pipeline = [{"$match": {"operationType": {"$in": ["insert", "update", "replace", "delete"]}}}]
+    async with db.orders.watch(pipeline, full_document="updateLookup") as stream:
+        # Rebuild once the stream is open so no change between the read and the watch is lost
+        await load_order_books()
+        async for change in stream:
+            apply_order_change(change)
+
+async def poll_order_books(loaded_at: Optional[datetime]):
+    """Apply orders updated since the last poll; rebuild now and then to drop deleted ones"""
+    since = loaded_at - timedelta(seconds=ORDER_BOOK_POLL_OVERLAP_SECONDS) if loaded_at else None
+    next_rebuild = time.monotonic() + ORDER_BOOK_REBUILD_SECONDS if loaded_at else 0
+    while True:
+        try:
+            if time.monotonic() >= next_rebuild:
+                started = await load_order_books()
+                next_rebuild = time.monotonic() + ORDER_BOOK_REBUILD_SECONDS
+            else:
+                started = datetime.now(timezone.utc)
+                orders = await db.orders.find({"updated_at": {"$gte": since}}, ORDER_BOOK_FIELDS).to_list(None)
+                for order in orders:
+                    order_books.sync(order)
+            since = started - timedelta(seconds=ORDER_BOOK_POLL_OVERLAP_SECONDS)
+        except Exception as e:
+            logger.error(f"Error polling order books: {e}")
+        await asyncio.sleep(ORDER_BOOK_POLL_SECONDS)
+
+async def sync_order_books(loaded_at: Optional[datetime]):
+    """Follow the other workers' order writes, like BanCache._sync"""
+    if ORDER_BOOK_SYNC == 'poll':
+        await poll_order_books(loaded_at)
+    while True:
+        try:
+            await watch_order_books()
+        except asyncio.CancelledError:
+            raise
+        except OperationFailure as e:
+            if e.code == CHANGE_STREAM_UNSUPPORTED:
+                logger.info(f"Change streams unavailable, polling orders every {ORDER_BOOK_POLL_SECONDS}s")
+                await poll_order_books(loaded_at)
+            logger.error(f"Order change stream failed: {e}")
+            await asyncio.sleep(ORDER_BOOK_POLL_SECONDS)
+        except Exception as e:
+            logger.error(f"Order change stream failed: {e}")
+            await asyncio.sleep(ORDER_BOOK_POLL_SECONDS)
+
+async def save_order_books():
+    if not order_books.dirty:
+        return
+    # dump() is a plain copy taken on the loop; only the file write leaves it
+    snapshot = order_books.dump()
+    try:
+        await asyncio.to_thread(order_book_snapshots.write, snapshot)
+    except Exception as e:
+        order_books.dirty = True
+        logger.error(f"Error writing order book snapshot: {e}")
+
+async def maintain_order_books():
+    """Expiry and snapshots, each on its own interval"""
+    now = time.monotonic()
+    next_expire = now + ORDER_BOOK_EXPIRE_SECONDS
+    next_snapshot = now + ORDER_BOOK_SNAPSHOT_SECONDS
+    while True:
+        now = time.monotonic()
+        if now >= next_expire:
+            expired = order_books.expire()
+            if expired:
+                logger.info(f"{expired} orders aged out of the order books")
+                for _id, order_id in list(order_book_ids.items()):
+                    if order_id not in order_books.where:
+                        del order_book_ids[_id]
+            next_expire = time.monotonic() + ORDER_BOOK_EXPIRE_SECONDS
+        if now >= next_snapshot:
+            await save_order_books()
+            next_snapshot = time.monotonic() + ORDER_BOOK_SNAPSHOT_SECONDS
+        await asyncio.sleep(max(min(next_expire, next_snapshot) - time.monotonic(), 0))
+
+def find_book(project: str, server_name: str):
+    book = order_books.book(project, server_name)
+    if book is None:
+        raise HTTPException(status_code=404, detail="No open orders for this server")
+    return book
+
+@api_router.get("/orders/book")
+async def get_order_book(project: str, server_name: str, depth: int = Query(10, ge=1, le=100)):
+    """Best bid/ask, spread and the top of each side for one server"""
+    return {"project": project, "server_name": server_name, **find_book(project, server_name).summary(depth)}
+
+@api_router.get("/orders/book/matches")
+async def get_order_book_matches(project: str, server_name: str, limit: int = Query(50, ge=1, le=1000)):
+    """Fills price-time matching would produce now (proposals; POST /orders/book/fill executes one)"""
+    return {"matches": find_book(project, server_name).matches(limit)}
+
+async def fill_order(order: dict, amount: int) -> dict:
+    """Complete a fully filled order, or shrink it to the rest at the same price per 1kk"""
+    left = order["amount"] - amount
+    if left > 0:
+        updates = {"amount": left, "price": round(order["price"] * left / order["amount"], 2)}
+    else:
+        updates = {"status": "completed"}
+    updates["updated_at"] = datetime.now(timezone.utc)
+    # Matching on the amount read before makes a concurrent fill of the same order lose
+    before = await db.orders.find_one_and_update(
+        {"id": order["id"], "status": "approved", "amount": order["amount"]},
+        {"$set": updates},
+        projection={"_id": 0},
+        return_document=ReturnDocument.BEFORE
+    )
+    if not before:
+        raise HTTPException(status_code=409, detail="Order changed, reload the book")
+    after = {**before, **updates}
+    await apply_order_stats(before, after)
+    order_books.apply(before, after)
+    return after
+
+@api_router.post("/orders/book/fill")
+async def fill_order_book_match(request: OrderFill, x_actor: Optional[str] = Header(None)):
+    """Execute one match: both orders fill by the smaller amount at the resting order's price"""
+    try:
+        buy, sell = await asyncio.gather(
+            db.orders.find_one({"id": request.buy_order_id}, {"_id": 0}),
+            db.orders.find_one({"id": request.sell_order_id}, {"_id": 0}),
+        )
+    except Exception as e:
+        logger.error(f"Error loading orders to fill: {e}")
+        raise HTTPException(status_code=500, detail="Failed to fill orders")
+    if not buy or not sell:
+        raise HTTPException(status_code=404, detail="Order not found")
+    if buy.get("order_type") != "buy" or sell.get("order_type") != "sell":
+        raise HTTPException(status_code=400, detail="Expected a buy order and a sell order")
+    if (buy.get("project"), buy.get("server_name")) != (sell.get("project"), sell.get("server_name")):
+        raise HTTPException(status_code=400, detail="Orders are on different servers")
+    if buy.get("user_id") == sell.get("user_id"):
+        raise HTTPException(status_code=400, detail="Orders belong to the same user")
+    if not (order_books.listed(buy) and order_books.listed(sell)):
+        raise HTTPException(status_code=409, detail="Order is no longer open")
+    buy_unit = unit_price(float(buy.get("price") or 0), int(buy.get("amount") or 0))
+    sell_unit = unit_price(float(sell.get("price") or 0), int(sell.get("amount") or 0))
+    if sell_unit > buy_unit:
+        raise HTTPException(status_code=409, detail="Prices do not cross")
+    
+    amount = min(buy["amount"], sell["amount"])
+    resting = buy if (created_ms(buy), buy["id"]) < (created_ms(sell), sell["id"]) else sell
+    unit = buy_unit if resting is buy else sell_unit
+    await fill_order(buy, amount)
+    await fill_order(sell, amount)
+    fill = {
+        "buy_order_id": buy["id"], "sell_order_id": sell["id"],
+        "buyer_id": buy.get("user_id"), "seller_id": sell.get("user_id"),
+        "amount": amount, "unit_price": unit, "total": round(unit * amount / UNIT, 2),
+    }
+    audit_log.record(
+        "fill_order", buy["id"], x_actor,
+        sell_order_id=sell["id"], amount=amount, total=fill["total"]
+    )
+    logger.info(f"Filled {buy['id']} against {sell['id']} for {amount}")
+    return {"success": True, **fill}
+
+@api_router.get("/orders/{order_id}/counterparty")
+async def get_counterparty(order_id: str):
+    """Best opposite order that crosses this order's price per 1kk, excluding the user's own"""
+    try:
+        order = await db.orders.find_one({"id": order_id}, {"_id": 0})
+    except Exception as e:
+        logger.error(f"Error getting counterparty: {e}")
+        raise HTTPException(status_code=500, detail="Failed to get counterparty")
+    if not order:
+        raise HTTPException(status_code=404, detail="Order not found")
+    book = order_books.book(order.get("project"), order.get("server_name"))
+    if book is None or order.get("order_type") not in ("buy", "sell"):
+        return {"counterparty": None}
+    unit = unit_price(float(order.get("price") or 0), int(order.get("amount") or 0))
+    return {"counterparty": book.counterparty(order["order_type"], unit, order.get("user_id"))}
+
+# ==========================================
+# ADMIN NOTIFICATIONS
+# ==========================================
+# Orders from the bot are announced by the bot itself; everything else (Web App)
+# is announced here, fire-and-forget, like sendTelegramNotificationAsync in server.js.
+
+BOT_TOKEN = os.environ.get('BOT_TOKEN', '')
+ADMIN_USER_ID = os.environ.get('ADMIN_USER_ID', '7858974852')
+NOTIFY_TIMEOUT = float(os.environ.get('NOTIFY_TIMEOUT', '10'))
+
+notification_tasks = set()
+
+def send_admin_message(text: str):
+    """Blocking Bot API sendMessage; runs in a worker thread"""
+    payload = json.dumps({"chat_id": ADMIN_USER_ID, "text": text, "parse_mode": "HTML"}).encode()
+    request = urllib.request.Request(
+        f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage",
+        data=payload,
+        headers={"Content-Type": "application/json"},
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=NOTIFY_TIMEOUT) as response:
+            response.read()
+    except urllib.error.HTTPError as e:
+        logger.error(f"Telegram notification failed: {e.code} {e.read()[:500]!r}")
+    except Exception as e:
+        logger.error(f"Telegram notification failed: {e}")
+
+def notify_admin(text: str):
+    """Send without delaying the response; failures are only logged"""
+    if not BOT_TOKEN:
+        logger.warning("BOT_TOKEN is not set, admin notification skipped")
+        return
+    task = asyncio.create_task(asyncio.to_thread(send_admin_message, text))
+    notification_tasks.add(task)
+    task.add_done_callback(notification_tasks.discard)
+
+def order_notification(order: dict) -> str:
+    type_label = "🛒 Покупка" if order.get("order_type") == "buy" else "💰 Продажа"
+    status_label = "✅ Одобрено" if order.get("status") == "approved" else "⏳ Ожидает модерации"
+    return (
+        f"🧾 <b>Новая заявка</b>\n\n"
+        f"Тип: <b>{type_label}</b>\n"
+        f"Статус: {status_label}\n"
+        f"Пользователь: @{html.escape(order.get('username') or 'unknown')}\n"
+        f"Сервер: {html.escape(order.get('server_name') or '—')}\n"
+        f"Количество: {(order.get('amount') or 0) / 1_000_000:.1f}кк\n"
+        f"Сумма: {order.get('price')} ₽\n"
+        f"Источник: {html.escape(order.get('source') or 'webapp')}"
+    )
+
+# ==========================================
+# ORDERS ENDPOINTS
+# ==========================================
+
+async def set_order_status(order_id: str, status: str) -> dict:
+    """Set the status of an order and return the updated document"""
+    now = datetime.now(timezone.utc)
+    before = await db.orders.find_one_and_update(
+        {"id": order_id},
+        {"$set": {"status": status, "updated_at": now}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.BEFORE
+    )
+    if not before:
+        raise HTTPException(status_code=404, detail="Order not found")
+    
+    order = {**before, "status": status, "updated_at": now}
+    await apply_order_stats(before, order)
+    order_books.apply(before, order)
+    return order
+
+@api_router.post("/orders")
+async def create_order(request: OrderCreate):
+    """Create an order (buy orders are approved immediately, sell orders wait for moderation)"""
+    if not request.user_id:
+        raise HTTPException(status_code=400, detail="Telegram user not provided")
+    if not request.server_id and not request.server_name:
+        raise HTTPException(status_code=400, detail="Server not specified")
+    if not request.amount or request.amount < MIN_ORDER_AMOUNT:
+        raise HTTPException(status_code=400, detail="Amount must be at least 100,000")
+    
+    try:
+        if request.idempotency_key:
+            expired = datetime.now(timezone.utc) - timedelta(seconds=IDEMPOTENCY_KEY_TTL)
+            existing = await db.orders.find_one(
+                {"idempotency_key": request.idempotency_key, "created_at": {"$gte": expired}}, {"_id": 0}
+            )
+            if existing:
+                return {"success": True, "duplicate": True, **existing}
+            # Past the TTL the key is released so it can start a new order
+            await db.orders.update_many(
+                {"idempotency_key": request.idempotency_key, "created_at": {"$lt": expired}},
+                {"$unset": {"idempotency_key": ""}}
+            )
+        
+        order = Order(
+            **request.model_dump(exclude_none=True),
+            status="approved" if request.order_type == "buy" else "pending"
+        )
+        doc = order.model_dump()
+        try:
+            await db.orders.insert_one(doc)
+        except DuplicateKeyError:
+            # A concurrent request with the same idempotency key won the race
+            existing = None
+            if request.idempotency_key:
+                existing = await db.orders.find_one({"idempotency_key": request.idempotency_key}, {"_id": 0})
+            if not existing:
+                # Another unique index, or the winning order is already gone
+                raise HTTPException(status_code=409, detail="Conflicting order, please retry")
+            return {"success": True, "duplicate": True, **existing}
+        doc.pop("_id", None)
+        await apply_order_stats(None, doc)
+        order_books.apply(None, doc)
+        
+        logger.info(f"Order {order.id} created: {order.order_type} by @{order.username}, amount {order.amount}")
+        if doc.get("source") != "bot":
+            notify_admin(order_notification(doc))
+        return {"success": True, **doc}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error creating order: {e}")
+        raise HTTPException(status_code=500, detail="Failed to create order")
+
+@api_router.get("/orders")
+async def get_orders(
+    order_type: Optional[OrderType] = None,
+    status: Optional[OrderStatus] = None,
+    user_id: Optional[int] = None,
+    project: Optional[str] = None,
+    source: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1),
+):
+    """Get orders, newest first, with optional filters"""
+    filters = {
+        "order_type": order_type,
+        "status": status,
+        "user_id": user_id,
+        "project": project,
+        "source": source,
+    }
+    query = {key: value for key, value in filters.items() if value is not None}
+    
+    try:
+        cursor = db.orders.find(query, {"_id": 0}).sort("created_at", -1)
+        if limit:
+            cursor = cursor.limit(limit)
+        return json_response(await cursor.to_list(None))
+    except Exception as e:
+        logger.error(f"Error getting orders: {e}")
+        raise HTTPException(status_code=500, detail="Failed to get orders")
+
+@api_router.patch("/orders/{order_id}")
+async def update_order(order_id: str, request: OrderUpdate, x_actor: Optional[str] = Header(None)):
+    """Update amount, price, contact or status of an order"""
+    updates = request.model_dump(exclude_none=True)
+    updates["updated_at"] = datetime.now(timezone.utc)
+    
+    before = await db.orders.find_one_and_update(
+        {"id": order_id},
+        {"$set": updates},
+        projection={"_id": 0},
+        return_document=ReturnDocument.BEFORE
+    )
+    if not before:
+        raise HTTPException(status_code=404, detail="Order not found")
+    
+    order = {**before, **updates}
+    await apply_order_stats(before, order)
+    order_books.apply(before, order)
+    changes = {field: [before.get(field), value] for field, value in updates.items() if field != "updated_at"}
+    audit_log.record("update_order", order_id, x_actor, changes=changes)
+    
+    logger.info(f"Order {order_id} updated")
+    return {"success": True, **order}
+
+@api_router.patch("/orders/{order_id}/approve")
+async def approve_order(order_id: str, x_actor: Optional[str] = Header(None)):
+    """Approve an order"""
+    order = await set_order_status(order_id, "approved")
+    audit_log.record("approve_order", order_id, x_actor, user_id=order.get("user_id"), amount=order.get("amount"))
+    logger.info(f"Order {order_id} approved")
+    return {"success": True, **order}
+
+@api_router.patch("/orders/{order_id}/reject")
+async def reject_order(order_id: str, x_actor: Optional[str] = Header(None)):
+    """Reject an order"""
+    order = await set_order_status(order_id, "rejected")
+    audit_log.record("reject_order", order_id, x_actor, user_id=order.get("user_id"), amount=order.get("amount"))
+    logger.info(f"Order {order_id} rejected")
+    return {"success": True, **order}
+
+@api_router.delete("/orders/{order_id}")
+async def delete_order(order_id: str, x_actor: Optional[str] = Header(None)):
+    """Delete an order"""
+    order = await db.orders.find_one_and_delete({"id": order_id}, projection={"_id": 0})
+    if not order:
+        raise HTTPException(status_code=404, detail="Order not found")
+    await apply_order_stats(order, None)
+    order_books.apply(order, None)
+    audit_log.record(
+        "delete_order", order_id, x_actor,
+        user_id=order.get("user_id"), status=order.get("status"), amount=order.get("amount")
+    )
+    
+    logger.info(f"Order {order_id} deleted")
+    return {"success": True, "deleted": True, "order": order}
+
+async def conditional_stats(request: Request, project: str, order_type: str):
+    """Stats response that answers 304 while the project's stats version is unchanged"""
+    etag = f'W/"stats-{project}-{order_type}-{await get_resource_version(f"stats:{project}")}"'
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return json_response(await read_server_stats(project, order_type), {"ETag": etag})
+
+@api_router.get("/orders/stats/servers")
+async def get_seller_stats(request: Request, project: str = "GTA5RP"):
+    """Server statistics for sellers"""
+    try:
+        return await conditional_stats(request, project, "sell")
+    except Exception as e:
+        logger.error(f"Error getting seller stats: {e}")
+        raise HTTPException(status_code=500, detail="Failed to get server stats")
+
+@api_router.get("/orders/stats/buyers")
+async def get_buyer_stats(request: Request, project: str = "GTA5RP"):
+    """Server statistics for buyers"""
+    try:
+        return await conditional_stats(request, project, "buy")
+    except Exception as e:
+        logger.error(f"Error getting buyer stats: {e}")
+        raise HTTPException(status_code=500, detail="Failed to get buyer stats")
+
+@api_router.get("/orders/stats/flow")
+async def get_order_flow(project: str = "GTA5RP", hours: float = Query(24, gt=0, le=24 * 30)):
+    """Buy and sell volume submitted per server within the last `hours`, whatever the moderation status"""
+    since = datetime.now(timezone.utc) - timedelta(hours=hours)
+    pipeline = [
+        # Served by the (project, created_at) index; rejected orders never were real demand or supply
+        {"$match": {"project": project, "created_at": {"$gte": since}, "status": {"$ne": "rejected"}}},
+        {"$group": {
+            "_id": {"server_name": "$server_name", "order_type": "$order_type"},
+            "orders": {"$sum": 1},
+            "amount": {"$sum": {"$ifNull": ["$amount", 0]}},
+        }},
+    ]
+    try:
+        groups = await db.orders.aggregate(pipeline).to_list(None)
+    except Exception as e:
+        logger.error(f"Error getting order flow: {e}")
+        raise HTTPException(status_code=500, detail="Failed to get order flow")
+
+    servers = {}
+    for group in groups:
+        server_name, order_type = group["_id"].get("server_name"), group["_id"].get("order_type")
+        if order_type not in ("buy", "sell"):
+            continue
+        entry = servers.setdefault(server_name, {
+            "server_name": server_name, "buy_orders": 0, "buy_amount": 0, "sell_orders": 0, "sell_amount": 0,
+        })
+        entry[f"{order_type}_orders"] += group["orders"]
+        entry[f"{order_type}_amount"] += group["amount"]
+    return list(servers.values())
+
+@api_router.get("/orders/stats/user/{user_id}")
+async def get_user_stats(user_id: int, source: Optional[str] = None):
+    """Order count, amount and price totals for one user, by type and status"""
+    match = {"user_id": user_id}
+    if source:
+        match["source"] = source
+    pipeline = [
+        # Served by the (user_id, created_at) index
+        {"$match": match},
+        {"$group": {
+            "_id": {"order_type": "$order_type", "status": "$status"},
+            "count": {"$sum": 1},
+            "amount": {"$sum": {"$ifNull": ["$amount", 0]}},
+            "price": {"$sum": {"$ifNull": ["$price", 0]}},
+        }},
+    ]
+    try:
+        groups = await db.orders.aggregate(pipeline).to_list(None)
+    except Exception as e:
+        logger.error(f"Error getting user stats: {e}")
+        raise HTTPException(status_code=500, detail="Failed to get user stats")
+
+    totals = {"orders": 0, "amount": 0, "price": 0}
+    by_type = {}
+    by_status = {}
+    for group in groups:
+        order_type, status = group["_id"].get("order_type"), group["_id"].get("status")
+        for key, bucket in ((order_type, by_type), (status, by_status)):
+            entry = bucket.setdefault(key, {"orders": 0, "amount": 0, "price": 0})
+            entry["orders"] += group["count"]
+            entry["amount"] += group["amount"]
+            entry["price"] += group["price"]
+        totals["orders"] += group["count"]
+        totals["amount"] += group["amount"]
+        totals["price"] += group["price"]
+    return {"user_id": user_id, **totals, "by_type": by_type, "by_status": by_status}
+
+@api_router.post("/orders/stats/rebuild")
+async def rebuild_stats(x_actor: Optional[str] = Header(None)):
+    """Recompute server stats from approved orders"""
+    try:
+        servers = await rebuild_server_stats()
+        audit_log.record("rebuild_stats", "server_stats", x_actor, servers=servers)
+        return {"success": True, "servers": servers}
+    except Exception as e:
+        logger.error(f"Error rebuilding server stats: {e}")
+        raise HTTPException(status_code=500, detail="Failed to rebuild server stats")
+
+# ==========================================
+# AUDIT LOG ENDPOINTS
+# ==========================================
+
+@api_router.get("/audit")
+async def get_audit_log(
+    actor: Optional[str] = None,
+    target: Optional[str] = None,
+    action: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    after: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1),
+):
+    """Audit entries, newest first, filtered by admin, target, action and time range"""
+    conditions = []
+    for field, value in (("actor", actor), ("target", target), ("action", action)):
+        if value is not None:
+            conditions.append({field: value})
+    if since:
+        conditions.append({"ts": {"$gte": since}})
+    if until:
+        conditions.append({"ts": {"$lt": until}})
+    if after:
+        ts, last_id = decode_time_cursor(after)
+        conditions.append({"$or": [{"ts": {"$lt": ts}}, {"ts": ts, "id": {"$lt": last_id}}]})
+    query = {"$and": conditions} if conditions else {}
+    
+    try:
+        limit = min(limit or MAX_PAGE_SIZE, MAX_PAGE_SIZE)
+        cursor = db.audit_log.find(query, {"_id": 0}).sort([("ts", -1), ("id", -1)]).limit(limit)
+        entries = await cursor.to_list(None)
+    except Exception as e:
+        logger.error(f"Error reading audit log: {e}")
+        raise HTTPException(status_code=500, detail="Failed to read audit log")
+    headers = {}
+    if len(entries) == limit:
+        last = entries[-1]
+        headers["X-Next-Cursor"] = encode_cursor(last["ts"], last["id"])
+    return json_response(entries, headers)
+
+# ==========================================
+# EXPORT
+# ==========================================
+
+EXPORT_FIELDS = {
+    "orders": [
+        "id", "created_at", "updated_at", "order_type", "status", "project", "server_name", "server_id",
+        "user_id", "username", "amount", "price", "contact", "refund_enabled", "source",
+    ],
+    "bans": ["user_id", "username", "banned_at", "banned_until", "banned_by"],
+}
+EXPORT_CHUNK_SIZE = 64 * 1024
+EXPORT_BATCH_SIZE = 1000
+
+async def csv_stream(cursor, fields: List[str]):
+    """CSV rows from the cursor, yielded in ~64 KB chunks"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fields)
+    async for doc in cursor:
+        writer.writerow([
+            value.isoformat() if isinstance(value, datetime) else ("" if value is None else value)
+            for value in (doc.get(field) for field in fields)
+        ])
+        if buffer.tell() >= EXPORT_CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+async def gzip_stream(chunks):
+    """Compress a text/bytes stream into a .gz file on the fly"""
+    # wbits=31: gzip header and trailer instead of a raw zlib stream
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, 31)
+    try:
+        async for chunk in chunks:
+            data = compressor.compress(chunk.encode() if isinstance(chunk, str) else chunk)
+            if data:
+                yield data
+    except Exception as e:
+        # Headers are already sent: re-raising aborts the chunked response, so the
+        # client sees a failed download instead of a clean end of a truncated file
+        logger.error(f"Error streaming export: {e}")
+        raise
+    yield compressor.flush()
+
+def export_response(kind: str, cursor, fmt: str) -> StreamingResponse:
+    cursor = cursor.batch_size(EXPORT_BATCH_SIZE)
+    rows = csv_stream(cursor, EXPORT_FIELDS[kind]) if fmt == "csv" else ndjson_stream(cursor)
+    filename = f"{kind}-{datetime.now(timezone.utc):%Y%m%d-%H%M%S}.{fmt}.gz"
+    return StreamingResponse(
+        gzip_stream(rows),
+        media_type="application/gzip",
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename}"',
+            # Already compressed: keeps the gzip/brotli middleware from wrapping it again
+            "Content-Encoding": "identity",
+        }
+    )
+
+@api_router.get("/export/orders")
+async def export_orders(
+    order_type: Optional[OrderType] = None,
+    status: Optional[OrderStatus] = None,
+    project: Optional[str] = None,
+    fmt: str = Query("csv", alias="format", pattern="^(csv|ndjson)$"),
+):
+    """Stream all matching orders, oldest first, as a gzipped CSV/NDJSON file"""
+    filters = {"order_type": order_type, "status": status, "project": project}
+    query = {key: value for key, value in filters.items() if value is not None}
+    cursor = db.orders.find(query, {"_id": 0, "idempotency_key": 0}).sort("created_at", 1)
+    return export_response("orders", cursor, fmt)
+
+@api_router.get("/export/bans")
+async def export_bans(fmt: str = Query("csv", alias="format", pattern="^(csv|ndjson)$")):
+    """Stream active bans as a gzipped CSV/NDJSON file"""
+    query = active_ban_filter(datetime.now(timezone.utc))
+    cursor = db.banned_users.find(query, {"_id": 0, "id": 0}).sort("user_id", 1)
+    return export_response("bans", cursor, fmt)
+
 # Include the router in the main app
 app.include_router(api_router)
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus text exposition"""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+# Brotli when brotli-asgi is installed (with gzip for clients without br), otherwise gzip
+if BrotliMiddleware:
+    app.add_middleware(BrotliMiddleware, minimum_size=COMPRESSION_MIN_SIZE, gzip_fallback=True)
+else:
+    app.add_middleware(GZipMiddleware, minimum_size=COMPRESSION_MIN_SIZE, compresslevel=COMPRESSION_LEVEL)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -208,6 +2125,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Outermost, so latency includes compression and CORS handling
+app.add_middleware(MetricsMiddleware)
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -215,6 +2135,149 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+# Fields that older versions stored as ISO strings
+LEGACY_DATE_FIELDS = {
+    "status_checks": ["timestamp"],
+    "banned_users": ["banned_at", "banned_until"],
+}
+
+async def migrate_legacy_dates():
+    """Convert ISO-string dates to native BSON datetimes in place"""
+    for collection, fields in LEGACY_DATE_FIELDS.items():
+        for field in fields:
+            try:
+                result = await db[collection].update_many(
+                    {field: {"$type": "string"}},
+                    [{"$set": {field: {"$dateFromString": {"dateString": f"${field}"}}}}]
+                )
+                if result.modified_count:
+                    logger.info(f"Converted {result.modified_count} {collection}.{field} values to datetimes")
+            except Exception as e:
+                logger.error(f"Error migrating {collection}.{field}: {e}")
+
+async def warm_connection_pool():
+    """Open minPoolSize connections up front with concurrent pings"""
+    if MONGO_MIN_POOL_SIZE <= 0:
+        return
+    results = await asyncio.gather(
+        *(db.command("ping") for _ in range(MONGO_MIN_POOL_SIZE)),
+        return_exceptions=True
+    )
+    failed = [r for r in results if isinstance(r, Exception)]
+    if failed:
+        logger.error(f"Connection pool warmup: {len(failed)} pings failed: {failed[0]}")
+
+async def create_indexes():
+    """Create indexes used by the ban, status and order endpoints"""
+    try:
+        # Independent builds: let the server run them in parallel
+        await asyncio.gather(
+            db.banned_users.create_index("user_id", unique=True),
+            # TTL index: MongoDB removes bans once banned_until has passed
+            db.banned_users.create_index("banned_until", expireAfterSeconds=0),
+            # Compound key doubles as the keyset pagination order
+            db.status_checks.create_index([("timestamp", 1), ("id", 1)]),
+            db.ban_changes.create_index("version", unique=True),
+            db.ban_changes.create_index("ts", expireAfterSeconds=BAN_CHANGES_RETENTION),
+            db.orders.create_index("id", unique=True),
+            db.orders.create_index(
+                "idempotency_key",
+                unique=True,
+                partialFilterExpression={"idempotency_key": {"$type": "string"}}
+            ),
+            db.orders.create_index([("order_type", 1), ("status", 1), ("created_at", -1)]),
+            db.orders.create_index([("user_id", 1), ("created_at", -1)]),
+            db.orders.create_index([("project", 1), ("server_name", 1)]),
+            db.orders.create_index([("project", 1), ("created_at", -1)]),
+            db.orders.create_index("updated_at"),
+            create_stats_indexes(),
+        )
+    except Exception as e:
+        logger.error(f"Error creating indexes: {e}")
+
+# Duration of each startup phase in ms, exposed by the readiness probe
+STARTUP_TIMINGS: dict = {}
+
+async def timed_phase(name: str, *steps):
+    """Run startup steps concurrently, record how long the phase took and return their results"""
+    started = time.perf_counter()
+    results = await asyncio.gather(*steps)
+    STARTUP_TIMINGS[name] = round((time.perf_counter() - started) * 1000, 1)
+    return results
+
+async def ensure_server_stats():
+    try:
+        # First start with materialized stats: build them from existing orders
+        if not await db.server_stats.find_one({}) and await db.orders.find_one({"status": "approved"}):
+            await rebuild_server_stats()
+    except Exception as e:
+        logger.error(f"Error building server stats: {e}")
+
+async def load_ban_cache():
+    global shared_bans
+    if BAN_STORE == 'shm':
+        shared_bans = SharedBanTable(BAN_SHM_PATH)
+        if not shared_bans.try_lead():
+            # Follower: answers checks from the leader's table, no own snapshot
+            return
+        ban_cache.publisher = shared_bans
+    try:
+        await ban_cache.load()
+        if ban_cache.publisher is not None:
+            ban_cache.publish()
+    except Exception as e:
+        logger.error(f"Error loading ban snapshot: {e}")
+
+def start_ban_sync():
+    if shared_bans is not None and not shared_bans.leader:
+        ban_cache.task = asyncio.create_task(follow_ban_leader())
+    else:
+        ban_cache.start()
+
+async def startup():
+    started = time.perf_counter()
+    connect_mongo()
+    await timed_phase("connect", warm_connection_pool())
+    # Dates must be native before the ban cache and TTL index see them
+    await timed_phase("migrate", migrate_legacy_dates())
+    # With a snapshot on disk the books are served from it while Mongo is read in the background
+    restored = restore_order_books()
+    books = [] if restored else [rebuild_order_books()]
+    warm = await timed_phase("warm", create_indexes(), create_audit_log(), ensure_server_stats(), load_ban_cache(), *books)
+    start_ban_sync()
+    audit_log.start()
+    # Polling continues from the startup rebuild; a restored snapshot is reloaded first
+    loaded_at = None if restored else warm[-1]
+    order_book_tasks.extend([
+        asyncio.create_task(sync_order_books(loaded_at)),
+        asyncio.create_task(maintain_order_books()),
+    ])
+    STARTUP_TIMINGS["total"] = round((time.perf_counter() - started) * 1000, 1)
+    logger.info(f"Startup finished (pid {os.getpid()}): {STARTUP_TIMINGS}")
+
+async def shutdown():
+    await status_buffer.close()
+    if notification_tasks:
+        await asyncio.gather(*notification_tasks, return_exceptions=True)
+    await audit_log.close()
+    for task in order_book_tasks:
+        task.cancel()
+    order_book_tasks.clear()
+    await save_order_books()
+    order_book_snapshots.close()
+    await ban_cache.stop()
+    if shared_bans is not None:
+        shared_bans.close()
+    if client is not None:
+        client.close()
+
+if __name__ == "__main__":
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="Backend maintenance commands")
+    parser.add_argument("command", choices=["rebuild-stats"])
+    args = parser.parse_args()
+    
+    connect_mongo()
+    if args.command == "rebuild-stats":
+        asyncio.run(rebuild_server_stats())
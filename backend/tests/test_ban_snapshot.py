@@ -0,0 +1,43 @@
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from server import BAN_CHANGES_GAP_SECONDS, servable_ban_changes  # noqa: E402
+
+NOW = datetime(2026, 1, 1, tzinfo=timezone.utc)
+FRESH = NOW - timedelta(seconds=1)
+STALE = NOW - timedelta(seconds=BAN_CHANGES_GAP_SECONDS + 1)
+
+
+def rows(*versions, ts=FRESH):
+    return [{"version": version, "user_id": str(version), "banned": True, "ts": ts} for version in versions]
+
+
+def test_all_changes_present():
+    changes = rows(6, 7)
+    assert servable_ban_changes(5, 7, changes, FRESH, NOW) == changes
+
+
+def test_recent_hole_serves_prefix_only():
+    changes = rows(6, 8)
+    assert servable_ban_changes(5, 8, changes, FRESH, NOW) == changes[:1]
+
+
+def test_stale_hole_needs_full_snapshot():
+    assert servable_ban_changes(5, 8, rows(6, 8, ts=STALE), STALE, NOW) is None
+
+
+def test_recent_missing_tail_waits():
+    assert servable_ban_changes(5, 7, rows(6), FRESH, NOW) == rows(6)
+
+
+def test_stale_missing_tail_needs_full_snapshot():
+    # The newest insert failed: without this the client would stay at version 6 forever
+    assert servable_ban_changes(5, 7, rows(6), STALE, NOW) is None
+    assert servable_ban_changes(5, 6, [], STALE, NOW) is None
+
+
+def test_missing_tail_on_counter_without_timestamp():
+    assert servable_ban_changes(5, 6, [], None, NOW) is None
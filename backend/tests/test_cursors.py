@@ -0,0 +1,36 @@
+import base64
+import json
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+
+import pytest
+from fastapi import HTTPException
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from server import decode_time_cursor, encode_cursor  # noqa: E402
+
+
+def raw_cursor(values) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip("=")
+
+
+def test_round_trip():
+    timestamp = datetime(2026, 1, 1, 12, 30, tzinfo=timezone.utc)
+    assert decode_time_cursor(encode_cursor(timestamp, "abc")) == (timestamp, "abc")
+
+
+@pytest.mark.parametrize("cursor", [
+    "not base64 !",
+    raw_cursor({"a": 1}),
+    raw_cursor(["2026-01-01T00:00:00+00:00"]),
+    raw_cursor(["yesterday", "abc"]),
+    raw_cursor([1767225600, "abc"]),
+    # An operator smuggled in as the id must never reach the query
+    raw_cursor(["2026-01-01T00:00:00+00:00", {"$gt": ""}]),
+])
+def test_tampered_cursor_is_rejected(cursor):
+    with pytest.raises(HTTPException) as error:
+        decode_time_cursor(cursor)
+    assert error.value.status_code == 400
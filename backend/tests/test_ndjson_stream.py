@@ -0,0 +1,76 @@
+import asyncio
+import json
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import server  # noqa: E402
+
+
+class SlowCursor:
+    """Motor-like cursor that records when the last document has been handed out"""
+
+    def __init__(self, docs, events):
+        self.docs = docs
+        self.events = events
+
+    def sort(self, *args, **kwargs):
+        return self
+
+    def limit(self, limit):
+        return self
+
+    def __aiter__(self):
+        return self._rows()
+
+    async def _rows(self):
+        for doc in self.docs:
+            yield doc
+            await asyncio.sleep(0)
+        self.events.append(("exhausted", None))
+
+
+class StubDb:
+    def __init__(self, cursor):
+        self.status_checks = self
+        self.cursor = cursor
+
+    def find(self, *args, **kwargs):
+        return self.cursor
+
+
+async def request(monkeypatch, path, headers):
+    events = []
+    docs = [{"id": str(i), "client_name": "c" * 50, "timestamp": "2026-01-01T00:00:00"} for i in range(200)]
+    monkeypatch.setattr(server, "db", StubDb(SlowCursor(docs, events)))
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+        "scheme": "http", "path": path, "raw_path": path.encode(), "root_path": "",
+        "query_string": b"format=ndjson", "headers": headers, "client": ("test", 1), "server": ("test", 80),
+    }
+
+    requested = asyncio.Event()
+
+    async def receive():
+        # The request body once, then nothing until the response is done (no disconnect)
+        if requested.is_set():
+            await asyncio.Event().wait()
+        requested.set()
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        events.append((message["type"], message))
+
+    await server.app(scope, receive, send)
+    return events
+
+
+def test_ndjson_first_row_is_sent_before_cursor_is_exhausted(monkeypatch):
+    events = asyncio.run(request(monkeypatch, "/api/status", [(b"accept-encoding", b"gzip, deflate, br")]))
+    kinds = [kind for kind, _ in events]
+    start = events[kinds.index("http.response.start")][1]
+    assert (b"content-encoding", b"identity") in start["headers"]
+    first_body = events[kinds.index("http.response.body")]
+    assert kinds.index("http.response.body") < kinds.index("exhausted")
+    assert json.loads(first_body[1]["body"])["id"] == "0"
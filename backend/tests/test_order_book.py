@@ -0,0 +1,101 @@
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from order_book import BUY, SELL, UNIT, OrderBook, OrderBooks  # noqa: E402
+
+
+def make_book(*orders):
+    """orders: (order_id, side, lot total price, amount in kk, user_id)"""
+    book = OrderBook()
+    for seq, (order_id, side, price, kk, user_id) in enumerate(orders):
+        book.add(order_id, side, price, kk * UNIT, user_id, created_ms=seq, seq=seq)
+    return book
+
+
+def test_small_buy_crosses_large_cheaper_sell():
+    # 690 per 1kk against 320 per 1kk: totals 690 < 3200 must not hide the cross
+    book = make_book(("b", BUY, 690, 1, 1), ("s", SELL, 3200, 10, 2))
+    fills = book.matches(10)
+    assert len(fills) == 1
+    assert fills[0]["amount"] == 1 * UNIT
+    assert fills[0]["unit_price"] == 690  # The bid rested first
+    assert fills[0]["total"] == 690
+
+
+def test_best_ask_is_cheapest_per_kk_not_smallest_lot():
+    book = make_book(("small", SELL, 500, 1, 1), ("large", SELL, 3000, 10, 2))
+    assert book.best(SELL)["id"] == "large"
+    assert book.best(SELL)["unit_price"] == 300
+
+
+def test_best_bid_is_highest_per_kk():
+    book = make_book(("small", BUY, 700, 1, 1), ("large", BUY, 6000, 10, 2))
+    assert book.best(BUY)["id"] == "small"
+
+
+def test_partial_fill_total_follows_amount():
+    book = make_book(("s", SELL, 3000, 10, 1), ("b", BUY, 1400, 4, 2))
+    fills = book.matches(10)
+    assert [(f["amount"], f["unit_price"], f["total"]) for f in fills] == [(4 * UNIT, 300, 1200)]
+
+
+def test_self_trade_skip_keeps_ask_for_later_bids():
+    book = make_book(
+        ("bidA", BUY, 100, 1, "A"),
+        ("bidB", BUY, 90, 1, "B"),
+        ("askA", SELL, 80, 1, "A"),
+    )
+    fills = book.matches(10)
+    assert [(f["buy_order_id"], f["sell_order_id"]) for f in fills] == [("bidB", "askA")]
+
+
+def test_no_fill_when_prices_do_not_cross():
+    book = make_book(("b", BUY, 3000, 10, 1), ("s", SELL, 350, 1, 2))
+    assert book.matches(10) == []
+
+
+def test_counterparty_uses_unit_price():
+    book = make_book(("s1", SELL, 500, 1, 1), ("s2", SELL, 3000, 10, 2))
+    assert book.counterparty(BUY, 310, user_id=3)["id"] == "s2"
+    assert book.counterparty(BUY, 310, user_id=2) is None
+
+
+def test_listed_only_open_orders():
+    books = OrderBooks(max_age_ms=3600 * 1000)
+    now = datetime.now(timezone.utc)
+    order = {"id": "o", "order_type": BUY, "status": "approved", "created_at": now}
+    assert books.listed(order)
+    assert not books.listed({**order, "status": "completed"})
+    assert not books.listed({**order, "created_at": now - timedelta(hours=2)})
+
+
+def test_expire_drops_aged_orders():
+    books = OrderBooks(max_age_ms=3600 * 1000)
+    now = datetime.now(timezone.utc)
+    for order_id, age in (("old", 50), ("new", 1)):
+        books.sync({
+            "id": order_id, "project": "P", "server_name": "S", "order_type": SELL, "status": "approved",
+            "price": 300, "amount": UNIT, "user_id": 1, "created_at": now - timedelta(minutes=age),
+        })
+    # Time passes: "old" is now past the window
+    books.max_age_ms = 30 * 60 * 1000
+    assert books.expire() == 1
+    assert list(books.book("P", "S").orders) == ["new"]
+    assert books.expire() == 0
+
+
+def test_sync_skips_unchanged_and_drops_closed_orders():
+    books = OrderBooks()
+    order = {
+        "id": "o", "project": "P", "server_name": "S", "order_type": BUY, "status": "approved",
+        "price": 300, "amount": UNIT, "user_id": 1, "created_at": datetime.now(timezone.utc),
+    }
+    assert books.sync(order)
+    assert not books.sync(dict(order))
+    assert books.sync({**order, "server_name": "T"})
+    assert books.book("P", "S").orders == {}
+    assert books.sync({**order, "server_name": "T", "status": "completed"})
+    assert books.where == {}
@@ -0,0 +1,69 @@
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "bot"))
+
+import telegram_bot_final as bot  # noqa: E402
+
+
+def test_lock_entry_removed_after_concurrent_holders_exit():
+    async def scenario():
+        order = []
+
+        async def press(user_id, name):
+            async with bot.order_lock(user_id):
+                order.append(f"{name} in")
+                await asyncio.sleep(0)
+                order.append(f"{name} out")
+
+        await asyncio.gather(*(press(1, name) for name in "abc"), press(2, "d"))
+        # Holders of the same user never overlap
+        user_1 = [step for step in order if step[0] in "abc"]
+        assert all(user_1[i][0] == user_1[i + 1][0] for i in range(0, len(user_1), 2))
+        assert bot._order_locks == {}
+
+    asyncio.run(scenario())
+
+
+def test_waiter_keeps_the_lock_entry():
+    async def scenario():
+        release = asyncio.Event()
+
+        async def hold():
+            async with bot.order_lock(1):
+                await release.wait()
+
+        holder = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        lock, count = bot._order_locks[1]
+        assert count == 2 and lock.locked()
+        release.set()
+        await asyncio.gather(holder, waiter)
+        assert bot._order_locks == {}
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_releases_its_count():
+    async def scenario():
+        release = asyncio.Event()
+
+        async def hold():
+            async with bot.order_lock(1):
+                await release.wait()
+
+        holder = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert bot._order_locks[1][1] == 1
+        release.set()
+        await holder
+        assert bot._order_locks == {}
+
+    asyncio.run(scenario())
@@ -0,0 +1,70 @@
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import server  # noqa: E402
+
+
+class SlowCollection:
+    """insert_many that blocks until released, like a slow Mongo round trip"""
+
+    def __init__(self):
+        self.release = asyncio.Event()
+        self.started = asyncio.Event()
+        self.inserted = []
+
+    async def insert_many(self, docs, ordered=True):
+        self.started.set()
+        await self.release.wait()
+        self.inserted.extend(docs)
+
+
+class StubDb:
+    def __init__(self):
+        self.status_checks = SlowCollection()
+
+
+def test_cancelled_flush_still_writes_the_batch(monkeypatch):
+    async def scenario():
+        db = StubDb()
+        monkeypatch.setattr(server, "db", db)
+        buffer = server.StatusWriteBuffer(window_ms=60_000, max_batch=2)
+
+        waiting = asyncio.create_task(buffer.add({"id": "a"}))
+        await asyncio.sleep(0)
+        # The second add fills the batch and flushes it; its caller then goes away
+        flushing = asyncio.create_task(buffer.add({"id": "b"}))
+        await db.status_checks.started.wait()
+        flushing.cancel()
+        await asyncio.gather(flushing, return_exceptions=True)
+        assert flushing.cancelled()
+
+        assert len(buffer.writes) == 1
+        db.status_checks.release.set()
+        await asyncio.wait_for(waiting, 1)
+        assert [doc["id"] for doc in db.status_checks.inserted] == ["a", "b"]
+        await buffer.close()
+        assert not buffer.writes
+
+    asyncio.run(scenario())
+
+
+def test_close_waits_for_writes_in_flight(monkeypatch):
+    async def scenario():
+        db = StubDb()
+        monkeypatch.setattr(server, "db", db)
+        buffer = server.StatusWriteBuffer(window_ms=60_000, max_batch=1)
+
+        adding = asyncio.create_task(buffer.add({"id": "a"}))
+        await db.status_checks.started.wait()
+        adding.cancel()
+        closing = asyncio.create_task(buffer.close())
+        await asyncio.sleep(0)
+        assert not closing.done()
+        db.status_checks.release.set()
+        await asyncio.wait_for(closing, 1)
+        assert [doc["id"] for doc in db.status_checks.inserted] == ["a"]
+
+    asyncio.run(scenario())
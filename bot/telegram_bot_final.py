@@ -5,14 +5,31 @@ Telegram бот для магазина игровых ресурсов с ед
 """
 
 import asyncio
+import bisect
+import gzip
+import hashlib
 import json
 import logging
-from datetime import datetime
-from typing import Dict, List, Optional
+import time
+import zlib
+from array import array
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from types import MappingProxyType
+from typing import Dict, List, Mapping, Optional
 import os
+import sys
+import tempfile
 import aiohttp
 from dotenv import load_dotenv
 
+try:
+    from PIL import Image
+except ImportError:  # Pillow не установлен — картинки отправляются как есть
+    Image = None
+
 # Загрузка .env файла
 load_dotenv()
 
@@ -29,6 +46,7 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.client.default import DefaultBotProperties
 
 # Логирование
@@ -52,6 +70,53 @@ API_BASE_URL = os.getenv("API_BASE_URL", "https://web-production-8aaaf.up.railwa
 # ✅ ИСПРАВЛЕНО: aiohttp timeout — используется ClientTimeout объект
 REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=15)
 
+# Выгрузки могут идти дольше обычного запроса: ограничиваем только паузу между кусками
+EXPORT_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=15, sock_read=120)
+EXPORT_CHUNK_SIZE = 64 * 1024
+EXPORT_MAX_DOCUMENT_SIZE = 50 * 1024 * 1024  # лимит Bot API на отправку файла
+
+# Максимум user_id в одном запросе /banned/check
+BAN_CHECK_BATCH_SIZE = 1000
+
+# Локальный фильтр банов: интервал догрузки изменений, полной пересинхронизации
+# и возраст, после которого фильтр считается устаревшим (проверка уходит в API)
+BAN_FILTER_REFRESH = float(os.getenv("BAN_FILTER_REFRESH", "15"))
+BAN_FILTER_FULL_RESYNC = float(os.getenv("BAN_FILTER_FULL_RESYNC", "600"))
+BAN_FILTER_MAX_AGE = float(os.getenv("BAN_FILTER_MAX_AGE", "120"))
+
+# Динамические цены: интервал пересчёта, окно (часы) поданных заявок, сила реакции на
+# перекос спроса/предложения (0.15 = ±15% при полном перекосе), границы относительно
+# базовой цены, коэффициент сглаживания (EMA) и "фоновый" объём в кк, гасящий шум на малых объёмах
+PRICING_REFRESH = float(os.getenv("PRICING_REFRESH", "300"))
+PRICING_WINDOW_HOURS = float(os.getenv("PRICING_WINDOW_HOURS", "24"))
+PRICING_SENSITIVITY = float(os.getenv("PRICING_SENSITIVITY", "0.15"))
+PRICING_MIN_FACTOR = float(os.getenv("PRICING_MIN_FACTOR", "0.85"))
+PRICING_MAX_FACTOR = float(os.getenv("PRICING_MAX_FACTOR", "1.2"))
+PRICING_SMOOTHING = float(os.getenv("PRICING_SMOOTHING", "0.3"))
+PRICING_VOLUME_PRIOR_KK = float(os.getenv("PRICING_VOLUME_PRIOR_KK", "20"))
+
+# Сколько секунд бот помнит созданные заявки для защиты от двойных нажатий
+# (бэкенд держит ключ идемпотентности столько же: IDEMPOTENCY_KEY_TTL)
+ORDER_DEDUP_TTL = int(os.getenv("ORDER_DEDUP_TTL", "600"))
+ORDER_DEDUP_MAX_ENTRIES = 10000
+
+# Антифлуд: группа обработчиков -> (токенов в секунду, размер корзины)
+THROTTLE_LIMITS = {
+    "navigation": (float(os.getenv("THROTTLE_NAV_RATE", "2")), int(os.getenv("THROTTLE_NAV_BURST", "6"))),
+    "orders": (float(os.getenv("THROTTLE_ORDER_RATE", "0.2")), int(os.getenv("THROTTLE_ORDER_BURST", "2"))),
+    "admin": (float(os.getenv("THROTTLE_ADMIN_RATE", "5")), int(os.getenv("THROTTLE_ADMIN_BURST", "20"))),
+}
+THROTTLE_SWEEP_INTERVAL = 300  # секунд между очистками неактивных корзин
+
+# Сколько сообщений помнить для пропуска повторных (неизменных) редактирований
+RENDERED_MESSAGES_MAX = 10000
+
+# Оптимизированные картинки меню (Telegram показывает фото не больше 1280px по длинной стороне)
+BOT_DIR = Path(__file__).resolve().parent
+IMAGE_CACHE_DIR = Path(os.getenv("IMAGE_CACHE_DIR", str(BOT_DIR / ".image_cache")))
+MENU_IMAGE_MAX_SIDE = 1280
+MENU_IMAGE_QUALITY = 82
+
 # Данные серверов и проектов
 GTA5RP_SERVERS = {
     "DOWNTOWN": {"id": 1, "sellPrice": 690, "buyPrice": 320},
@@ -114,6 +179,9 @@ PROJECTS = {
     }
 }
 
+# Цена для сервера, которого нет в таблице
+DEFAULT_SERVER_PRICES = MappingProxyType({"sellPrice": 700, "buyPrice": 350})
+
 VIRT_AMOUNTS_KK = [1, 2, 3, 4, 5, 6, 7, 8, 10, 15, 20]
 
 INFO_TEXTS = {
@@ -151,6 +219,59 @@ MENU_IMAGES = {
     "majestic": "majestic.jpg"
 }
 
+# ==========================================
+# Оптимизация картинок меню
+# ==========================================
+# Имя исходной картинки -> путь к оптимизированному варианту
+_optimized_images: Dict[str, str] = {}
+
+def optimize_menu_image(source: Path) -> Path:
+    """Сжатый вариант картинки в кэше на диске (ключ — хэш содержимого и настроек)"""
+    raw = source.read_bytes()
+    settings = f"{MENU_IMAGE_MAX_SIDE}:{MENU_IMAGE_QUALITY}".encode()
+    digest = hashlib.sha256(raw + settings).hexdigest()[:16]
+    target = IMAGE_CACHE_DIR / f"{digest}.jpg"
+    if target.exists():
+        return target
+
+    IMAGE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    with Image.open(source) as img:
+        img = img.convert("RGB")
+        img.thumbnail((MENU_IMAGE_MAX_SIDE, MENU_IMAGE_MAX_SIDE), Image.LANCZOS)
+        tmp = target.with_suffix(".tmp")
+        # Без exif/icc_profile — метаданные не копируются
+        img.save(tmp, "JPEG", quality=MENU_IMAGE_QUALITY, optimize=True, progressive=True)
+    os.replace(tmp, target)
+    return target
+
+def prepare_menu_images():
+    """Подготовить оптимизированные варианты всех картинок меню"""
+    names = set(MENU_IMAGES.values()) | {p["photo"] for p in PROJECTS.values()}
+    if Image is None:
+        logger.warning("Pillow не установлен — картинки меню отправляются без оптимизации")
+        return
+
+    for name in sorted(names):
+        source = BOT_DIR / name
+        if not source.exists():
+            continue
+        try:
+            variant = optimize_menu_image(source)
+            if variant.stat().st_size < source.stat().st_size:
+                _optimized_images[name] = str(variant)
+                logger.info(f"[IMAGES] {name}: {source.stat().st_size // 1024}KB -> {variant.stat().st_size // 1024}KB")
+        except Exception as e:
+            logger.error(f"[IMAGES] Не удалось оптимизировать {name}: {e}")
+
+def resolve_menu_image(name: Optional[str]) -> Optional[str]:
+    """Путь к картинке меню: оптимизированный вариант, иначе оригинал рядом с ботом"""
+    if not name:
+        return name
+    if name in _optimized_images:
+        return _optimized_images[name]
+    source = BOT_DIR / name
+    return str(source) if source.exists() else name
+
 # FSM состояния
 class UserStates(StatesGroup):
     selecting_action = State()
@@ -162,16 +283,55 @@ class UserStates(StatesGroup):
 # API CLIENT
 # ==========================================
 
+def actor_headers(actor: Optional[str]) -> dict:
+    """Заголовок X-Actor: кто из админов выполнил действие (для журнала аудита)"""
+    return {"X-Actor": actor} if actor else {}
+
+def actor_of(message: Message) -> str:
+    return str(message.from_user.id)
+
+def gzip_complete(path: str) -> bool:
+    """Файл распаковывается до конца и сходится по CRC"""
+    try:
+        with gzip.open(path, "rb") as f:
+            while f.read(EXPORT_CHUNK_SIZE):
+                pass
+        return True
+    except (OSError, EOFError, zlib.error):
+        return False
+
 class APIClient:
     """Клиент для работы с Backend API"""
 
     def __init__(self, base_url: str):
         self.base_url = base_url
+        # Кэш условных запросов: путь + параметры -> (ETag, тело ответа)
+        self._etag_cache: Dict[str, tuple] = {}
         logger.info(f"APIClient инициализирован: {self.base_url}")
 
-    async def create_order(self, order_data: dict) -> dict:
-        """Создать заявку"""
+    async def _get_json_conditional(self, path: str, params: dict = None):
+        """GET с If-None-Match: при 304 возвращает закэшированное тело, при ошибке — None"""
+        params = params or {}
+        key = f"{path}?{sorted(params.items())}"
+        cached = self._etag_cache.get(key)
+        headers = {"If-None-Match": cached[0]} if cached else {}
+        async with aiohttp.ClientSession(timeout=REQUEST_TIMEOUT) as session:
+            async with session.get(f"{self.base_url}{path}", params=params, headers=headers) as response:
+                if response.status == 304 and cached:
+                    return cached[1]
+                if response.status != 200:
+                    return None
+                body = await response.json()
+                etag = response.headers.get("ETag")
+                if etag:
+                    self._etag_cache[key] = (etag, body)
+                return body
+
+    async def create_order(self, order_data: dict, idempotency_key: str = None) -> dict:
+        """Создать заявку (повтор с тем же idempotency_key вернёт уже созданную)"""
         try:
+            if idempotency_key:
+                order_data = {**order_data, "idempotency_key": idempotency_key}
             async with aiohttp.ClientSession(timeout=REQUEST_TIMEOUT) as session:
                 async with session.post(f"{self.base_url}/orders", json=order_data) as response:
                     if response.status == 200:
@@ -199,11 +359,11 @@ class APIClient:
             logger.error(f"Error getting orders: {e}")
             return []
 
-    async def update_order(self, order_id: str, updates: dict) -> Optional[dict]:
+    async def update_order(self, order_id: str, updates: dict, actor: str = None) -> Optional[dict]:
         """Обновить заявку"""
         try:
             async with aiohttp.ClientSession(timeout=REQUEST_TIMEOUT) as session:
-                async with session.patch(f"{self.base_url}/orders/{order_id}", json=updates) as response:
+                async with session.patch(f"{self.base_url}/orders/{order_id}", json=updates, headers=actor_headers(actor)) as response:
                     if response.status == 200:
                         return await response.json()
                     else:
@@ -213,11 +373,11 @@ class APIClient:
             logger.error(f"Error updating order: {e}")
             return None
 
-    async def approve_order(self, order_id: str) -> Optional[dict]:
+    async def approve_order(self, order_id: str, actor: str = None) -> Optional[dict]:
         """Одобрить заявку"""
         try:
             async with aiohttp.ClientSession(timeout=REQUEST_TIMEOUT) as session:
-                async with session.patch(f"{self.base_url}/orders/{order_id}/approve") as response:
+                async with session.patch(f"{self.base_url}/orders/{order_id}/approve", headers=actor_headers(actor)) as response:
                     if response.status == 200:
                         return await response.json()
                     else:
@@ -227,11 +387,11 @@ class APIClient:
             logger.error(f"Error approving order: {e}")
             return None
 
-    async def reject_order(self, order_id: str) -> Optional[dict]:
+    async def reject_order(self, order_id: str, actor: str = None) -> Optional[dict]:
         """Отклонить заявку"""
         try:
             async with aiohttp.ClientSession(timeout=REQUEST_TIMEOUT) as session:
-                async with session.patch(f"{self.base_url}/orders/{order_id}/reject") as response:
+                async with session.patch(f"{self.base_url}/orders/{order_id}/reject", headers=actor_headers(actor)) as response:
                     if response.status == 200:
                         return await response.json()
                     else:
@@ -241,11 +401,11 @@ class APIClient:
             logger.error(f"Error rejecting order: {e}")
             return None
 
-    async def delete_order(self, order_id: str) -> bool:
+    async def delete_order(self, order_id: str, actor: str = None) -> bool:
         """Удалить заявку"""
         try:
             async with aiohttp.ClientSession(timeout=REQUEST_TIMEOUT) as session:
-                async with session.delete(f"{self.base_url}/orders/{order_id}") as response:
+                async with session.delete(f"{self.base_url}/orders/{order_id}", headers=actor_headers(actor)) as response:
                     return response.status == 200
         except Exception as e:
             logger.error(f"Error deleting order: {e}")
@@ -255,26 +415,45 @@ class APIClient:
         """Получить статистику по серверам (ПРОДАВЦЫ)"""
         try:
             params = {"project": project} if project else {}
-            async with aiohttp.ClientSession(timeout=REQUEST_TIMEOUT) as session:
-                async with session.get(f"{self.base_url}/orders/stats/servers", params=params) as response:
-                    if response.status == 200:
-                        return await response.json()
-                    else:
-                        return []
+            return await self._get_json_conditional("/orders/stats/servers", params) or []
         except Exception as e:
             logger.error(f"Error getting server stats: {e}")
             return []
 
+    async def get_user_stats(self, user_id: int, source: str = None) -> Optional[dict]:
+        """Сводка заявок пользователя (количество и объём по типам/статусам), None — если недоступна"""
+        try:
+            params = {"source": source} if source else {}
+            async with aiohttp.ClientSession(timeout=REQUEST_TIMEOUT) as session:
+                async with session.get(f"{self.base_url}/orders/stats/user/{user_id}", params=params) as response:
+                    if response.status != 200:
+                        return None
+                    body = await response.json()
+                    # Бэкенд без сводки (server.js) отвечает чем-то другим
+                    return body if isinstance(body, dict) and "orders" in body else None
+        except Exception as e:
+            logger.error(f"Error getting user stats: {e}")
+            return None
+
+    async def get_order_flow(self, project: str, hours: float) -> Optional[List[dict]]:
+        """Объём поданных заявок на покупку/продажу по серверам за последние hours часов, None — если недоступно"""
+        try:
+            params = {"project": project, "hours": hours}
+            async with aiohttp.ClientSession(timeout=REQUEST_TIMEOUT) as session:
+                async with session.get(f"{self.base_url}/orders/stats/flow", params=params) as response:
+                    if response.status != 200:
+                        return None
+                    body = await response.json()
+                    return body if isinstance(body, list) else None
+        except Exception as e:
+            logger.error(f"Error getting order flow: {e}")
+            return None
+
     async def get_buyer_stats(self, project: str = None) -> List[dict]:
         """Получить статистику по серверам (ПОКУПАТЕЛИ)"""
         try:
             params = {"project": project} if project else {}
-            async with aiohttp.ClientSession(timeout=REQUEST_TIMEOUT) as session:
-                async with session.get(f"{self.base_url}/orders/stats/buyers", params=params) as response:
-                    if response.status == 200:
-                        return await response.json()
-                    else:
-                        return []
+            return await self._get_json_conditional("/orders/stats/buyers", params) or []
         except Exception as e:
             logger.error(f"Error getting buyer stats: {e}")
             return []
@@ -295,7 +474,63 @@ class APIClient:
             logger.error(f"Error checking ban status: {e}")
             return {"banned": False}
     
-    async def ban_user(self, user_id: int, username: str = None, days: int = None, banned_by: str = "admin") -> bool:
+    async def check_users_banned(self, user_ids: List[int]) -> Dict[int, dict]:
+        """Проверить блокировку сразу для многих пользователей (один запрос на пачку)"""
+        result = {}
+        try:
+            async with aiohttp.ClientSession(timeout=REQUEST_TIMEOUT) as session:
+                for i in range(0, len(user_ids), BAN_CHECK_BATCH_SIZE):
+                    batch = [str(user_id) for user_id in user_ids[i:i + BAN_CHECK_BATCH_SIZE]]
+                    async with session.post(f"{self.base_url}/banned/check", json={"user_ids": batch}) as response:
+                        if response.status != 200:
+                            logger.error(f"Failed to check bans: {response.status}")
+                            return result
+                        data = await response.json()
+                        result.update({int(user_id): status for user_id, status in data.items()})
+        except Exception as e:
+            logger.error(f"Error checking ban status in bulk: {e}")
+        return result
+    
+    async def download_export(self, kind: str, fmt: str, dest: str) -> Optional[str]:
+        """Скачать выгрузку (.gz) потоком в файл, вернуть имя файла или None"""
+        try:
+            async with aiohttp.ClientSession(timeout=EXPORT_TIMEOUT) as session:
+                async with session.get(f"{self.base_url}/export/{kind}", params={"format": fmt}) as response:
+                    if response.status != 200:
+                        logger.error(f"Failed to export {kind}: {response.status}")
+                        return None
+                    with open(dest, "wb") as f:
+                        async for chunk in response.content.iter_chunked(EXPORT_CHUNK_SIZE):
+                            f.write(chunk)
+                    # Обрыв на стороне сервера даёт файл без gzip-трейлера — такой не отправляем
+                    if not await asyncio.to_thread(gzip_complete, dest):
+                        logger.error(f"Export {kind} is truncated or corrupt")
+                        return None
+                    disposition = response.content_disposition
+                    if disposition and disposition.filename:
+                        return disposition.filename
+                    return f"{kind}.{fmt}.gz"
+        except Exception as e:
+            logger.error(f"Error exporting {kind}: {e}")
+            return None
+    
+    async def get_ban_snapshot(self, since_version: int = None) -> Optional[dict]:
+        """Компактный список банов: полный или изменения после since_version"""
+        try:
+            params = {"since_version": since_version} if since_version is not None else {}
+            async with aiohttp.ClientSession(timeout=REQUEST_TIMEOUT) as session:
+                async with session.get(f"{self.base_url}/banned/snapshot", params=params) as response:
+                    if response.status == 200:
+                        data = await response.json()
+                        # server.js без снимков отвечает на этот путь как на /banned/{user_id}
+                        return data if "version" in data else None
+                    logger.error(f"Failed to get ban snapshot: {response.status}")
+                    return None
+        except Exception as e:
+            logger.error(f"Error getting ban snapshot: {e}")
+            return None
+    
+    async def ban_user(self, user_id: int, username: str = None, days: int = None, banned_by: str = "admin", actor: str = None) -> bool:
         """Заблокировать пользователя"""
         try:
             data = {
@@ -305,17 +540,17 @@ class APIClient:
                 "banned_by": banned_by
             }
             async with aiohttp.ClientSession(timeout=REQUEST_TIMEOUT) as session:
-                async with session.post(f"{self.base_url}/banned", json=data) as response:
+                async with session.post(f"{self.base_url}/banned", json=data, headers=actor_headers(actor)) as response:
                     return response.status == 200
         except Exception as e:
             logger.error(f"Error banning user: {e}")
             return False
     
-    async def unban_user(self, user_id: int) -> bool:
+    async def unban_user(self, user_id: int, actor: str = None) -> bool:
         """Разблокировать пользователя"""
         try:
             async with aiohttp.ClientSession(timeout=REQUEST_TIMEOUT) as session:
-                async with session.delete(f"{self.base_url}/banned/{user_id}") as response:
+                async with session.delete(f"{self.base_url}/banned/{user_id}", headers=actor_headers(actor)) as response:
                     return response.status == 200
         except Exception as e:
             logger.error(f"Error unbanning user: {e}")
@@ -324,12 +559,7 @@ class APIClient:
     async def get_banned_users(self) -> List[dict]:
         """Получить список заблокированных пользователей"""
         try:
-            async with aiohttp.ClientSession(timeout=REQUEST_TIMEOUT) as session:
-                async with session.get(f"{self.base_url}/banned") as response:
-                    if response.status == 200:
-                        return await response.json()
-                    else:
-                        return []
+            return await self._get_json_conditional("/banned") or []
         except Exception as e:
             logger.error(f"Error getting banned users: {e}")
             return []
@@ -352,6 +582,335 @@ async def notify_admin(text: str):
     except Exception as e:
         logger.error(f"[ADMIN NOTIFY] Ошибка: {e}")
 
+# ==========================================
+# Защита от дублей при создании заявок
+# ==========================================
+# user_id -> [лок, сколько задач его держат или ждут]
+_order_locks: Dict[int, list] = {}
+_recent_orders: "OrderedDict[str, tuple]" = OrderedDict()
+
+def make_idempotency_key(user_id: int, message, data: str) -> str:
+    """Ключ идемпотентности: одно и то же нажатие на одной отрисовке сообщения = одна заявка"""
+    if message is None:
+        return hashlib.sha256(f"{user_id}:0:{data}".encode()).hexdigest()
+    # Перерисовка сообщения на месте меняет edit_date: нажатие после неё — уже новая заявка
+    rendered = getattr(message, "edit_date", None) or getattr(message, "date", None)
+    if isinstance(rendered, datetime):
+        rendered = int(rendered.timestamp())
+    return hashlib.sha256(f"{user_id}:{message.message_id}:{rendered}:{data}".encode()).hexdigest()
+
+@asynccontextmanager
+async def order_lock(user_id: int):
+    """Лок на пользователя, чтобы параллельные нажатия создавали заявки по очереди.
+
+    Лок удаляется, только когда его никто не держит и не ждёт — иначе
+    следующее нажатие получило бы новый лок и пошло параллельно ожидающему.
+    """
+    entry = _order_locks.get(user_id)
+    if entry is None:
+        entry = _order_locks[user_id] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del _order_locks[user_id]
+
+def get_recent_order(key: str) -> Optional[dict]:
+    """Вернуть заявку, уже созданную по этому ключу (если ещё не истёк TTL)"""
+    now = time.monotonic()
+    while _recent_orders:
+        oldest_key, (created, _) = next(iter(_recent_orders.items()))
+        if now - created < ORDER_DEDUP_TTL:
+            break
+        del _recent_orders[oldest_key]
+    entry = _recent_orders.get(key)
+    return entry[1] if entry else None
+
+def remember_order(key: str, order: dict):
+    """Запомнить созданную заявку по ключу идемпотентности"""
+    _recent_orders[key] = (time.monotonic(), order)
+    _recent_orders.move_to_end(key)
+    while len(_recent_orders) > ORDER_DEDUP_MAX_ENTRIES:
+        _recent_orders.popitem(last=False)
+
+# ==========================================
+# THROTTLE MIDDLEWARE (антифлуд)
+# ==========================================
+class TokenBucket:
+    """Корзина токенов одного пользователя (slots — минимум памяти на пользователя)"""
+    __slots__ = ("tokens", "updated", "warned")
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens = tokens
+        self.updated = updated
+        self.warned = False
+
+class ThrottleMiddleware:
+    """Per-user token bucket: лишние апдейты отбрасываются до любых запросов к API"""
+
+    def __init__(self, limits: Dict[str, tuple], sweep_interval: float = THROTTLE_SWEEP_INTERVAL):
+        self.limits = limits
+        self.sweep_interval = sweep_interval
+        self.buckets: Dict[str, Dict[int, TokenBucket]] = {group: {} for group in limits}
+        self.last_sweep = time.monotonic()
+        self.dropped = 0
+
+    @staticmethod
+    def get_group(event) -> str:
+        if event.from_user.id == ADMIN_USER_ID:
+            return "admin"
+        if isinstance(event, CallbackQuery) and (event.data or "").startswith("amount_"):
+            return "orders"
+        return "navigation"
+
+    def consume(self, group: str, user_id: int, now: float) -> Optional[TokenBucket]:
+        """Списать токен. Возвращает корзину, если токенов не осталось, иначе None"""
+        rate, burst = self.limits[group]
+        buckets = self.buckets[group]
+        bucket = buckets.get(user_id)
+        if bucket is None:
+            buckets[user_id] = TokenBucket(burst - 1, now)
+            return None
+
+        bucket.tokens = min(burst, bucket.tokens + (now - bucket.updated) * rate)
+        bucket.updated = now
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            bucket.warned = False
+            return None
+        return bucket
+
+    def sweep(self, now: float):
+        """Удаляет корзины, которые уже полностью восстановились: они эквивалентны новым"""
+        for group, buckets in self.buckets.items():
+            rate, burst = self.limits[group]
+            idle = burst / rate if rate > 0 else self.sweep_interval
+            stale = [user_id for user_id, bucket in buckets.items() if now - bucket.updated >= idle]
+            for user_id in stale:
+                del buckets[user_id]
+        self.last_sweep = now
+
+    async def __call__(self, handler, event, data):
+        if not hasattr(event, 'from_user') or not event.from_user:
+            return await handler(event, data)
+
+        now = time.monotonic()
+        if now - self.last_sweep >= self.sweep_interval:
+            self.sweep(now)
+
+        bucket = self.consume(self.get_group(event), event.from_user.id, now)
+        if bucket is None:
+            return await handler(event, data)
+
+        self.dropped += 1
+        # Предупреждаем один раз за серию, дальше молча отбрасываем.
+        # Callback отвечаем всегда, иначе у пользователя крутятся "часики" на кнопке
+        warn = not bucket.warned
+        bucket.warned = True
+        try:
+            if isinstance(event, CallbackQuery):
+                await event.answer("⏳ Слишком часто, подождите немного" if warn else None)
+            elif isinstance(event, Message) and warn:
+                await event.answer("<b>⏳ Слишком много запросов, подождите немного</b>")
+        except Exception as e:
+            logger.error(f"[THROTTLE] Ошибка уведомления: {e}")
+        return
+
+throttle_middleware = ThrottleMiddleware(THROTTLE_LIMITS)
+
+# ==========================================
+# ЛОКАЛЬНЫЙ ФИЛЬТР БАНОВ
+# ==========================================
+
+class BanFilter:
+    """Копия списка банов в памяти: отсортированные user_id и сроки (мс, 0 = навсегда).
+
+    Память пропорциональна числу банов, проверка — бинарный поиск без запроса к API.
+    """
+
+    def __init__(self):
+        self.ids = array("q")
+        self.expires = array("q")
+        self.version = None
+        self.updated = 0.0  # monotonic время последней успешной синхронизации
+        self.last_full = 0.0
+        # Баны/разбаны этого бота: user_id -> (срок в мс или None для разбана, monotonic время)
+        self.local: Dict[int, tuple] = {}
+
+    def fresh(self) -> bool:
+        return self.version is not None and time.monotonic() - self.updated < BAN_FILTER_MAX_AGE
+
+    def lookup(self, user_id: int) -> Optional[int]:
+        """Срок бана в мс (0 = навсегда) или None, если пользователя нет в списке"""
+        i = bisect.bisect_left(self.ids, user_id)
+        if i < len(self.ids) and self.ids[i] == user_id:
+            return self.expires[i]
+        return None
+
+    def check(self, user_id: int) -> dict:
+        """Ответ в формате /banned/{user_id}"""
+        expires_ms = self.lookup(user_id)
+        if expires_ms is None:
+            return {"banned": False}
+        if expires_ms == 0:
+            return {"banned": True, "banned_until": None}
+        banned_until = datetime.fromtimestamp(expires_ms / 1000, timezone.utc)
+        if banned_until <= datetime.now(timezone.utc):
+            return {"banned": False}
+        return {"banned": True, "banned_until": banned_until.isoformat()}
+
+    def replace(self, bans: List[list]):
+        bans = sorted(bans)
+        self.ids = array("q", (user_id for user_id, _ in bans))
+        self.expires = array("q", (expires_ms for _, expires_ms in bans))
+
+    def add(self, user_id: int, expires_ms: int):
+        i = bisect.bisect_left(self.ids, user_id)
+        if i < len(self.ids) and self.ids[i] == user_id:
+            self.expires[i] = expires_ms
+        else:
+            self.ids.insert(i, user_id)
+            self.expires.insert(i, expires_ms)
+
+    def remove(self, user_id: int):
+        i = bisect.bisect_left(self.ids, user_id)
+        if i < len(self.ids) and self.ids[i] == user_id:
+            del self.ids[i]
+            del self.expires[i]
+
+    def local_ban(self, user_id: int, expires_ms: int):
+        """Бан из команды бота: виден сразу и не затирается ответом, запрошенным раньше"""
+        self.add(user_id, expires_ms)
+        self.local[user_id] = (expires_ms, time.monotonic())
+
+    def local_unban(self, user_id: int):
+        self.remove(user_id)
+        self.local[user_id] = (None, time.monotonic())
+
+    def apply(self, snapshot: dict):
+        """Применить ответ /banned/snapshot (полный или инкрементальный)"""
+        if snapshot.get("full"):
+            self.replace(snapshot["bans"])
+            self.last_full = time.monotonic()
+        else:
+            for user_id in snapshot["unbanned"]:
+                self.remove(user_id)
+            for user_id, expires_ms in snapshot["banned"]:
+                self.add(user_id, expires_ms)
+        self.version = snapshot["version"]
+        self.updated = time.monotonic()
+
+    async def refresh(self):
+        # Периодически берём полный список: он лечит пропущенные изменения
+        full = self.version is None or time.monotonic() - self.last_full >= BAN_FILTER_FULL_RESYNC
+        started = time.monotonic()
+        snapshot = await api_client.get_ban_snapshot(None if full else self.version)
+        if snapshot:
+            self.apply(snapshot)
+            # Локальные изменения, сделанные пока шёл запрос, в ответе ещё могут отсутствовать
+            for user_id, (expires_ms, changed) in list(self.local.items()):
+                if changed < started:
+                    del self.local[user_id]
+                elif expires_ms is None:
+                    self.remove(user_id)
+                else:
+                    self.add(user_id, expires_ms)
+
+    async def run(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"[BAN FILTER] Ошибка обновления: {e}")
+            await asyncio.sleep(BAN_FILTER_REFRESH)
+
+ban_filter = BanFilter()
+
+# ==========================================
+# ДИНАМИЧЕСКИЕ ЦЕНЫ
+# ==========================================
+
+def freeze_prices(prices: dict) -> Mapping:
+    """Неизменяемая таблица project -> server -> {"sellPrice", "buyPrice"}"""
+    return MappingProxyType({
+        project_key: MappingProxyType({
+            server: MappingProxyType(dict(data)) for server, data in servers.items()
+        })
+        for project_key, servers in prices.items()
+    })
+
+class PriceEngine:
+    """Цены серверов от базовых с поправкой на спрос (заявки на покупку) и предложение (на продажу).
+
+    Спрос и предложение — объём заявок, поданных за последние PRICING_WINDOW_HOURS,
+    независимо от модерации: покупки одобряются сразу, продажи ждут проверки, и
+    одобренный объём завышал бы спрос.
+
+    Пересчёт идёт в фоне; обработчики читают готовую неизменяемую таблицу,
+    которая целиком подменяется одним присваиванием.
+    """
+
+    def __init__(self, projects: dict):
+        self.base = {project_key: project["prices"] for project_key, project in projects.items()}
+        self.factors: Dict[tuple, float] = {}  # (project, server) -> сглаженный множитель
+        self.table = freeze_prices(self.base)
+        self.updated = None  # datetime последнего пересчёта
+
+    def price(self, project_key: str, server: str) -> Mapping:
+        return self.table[project_key].get(server, DEFAULT_SERVER_PRICES)
+
+    @staticmethod
+    def target_factor(demand: int, supply: int) -> float:
+        prior = PRICING_VOLUME_PRIOR_KK * 1_000_000
+        imbalance = (demand - supply) / (demand + supply + prior)
+        factor = 1 + PRICING_SENSITIVITY * imbalance
+        return min(max(factor, PRICING_MIN_FACTOR), PRICING_MAX_FACTOR)
+
+    def update(self, project_key: str, flow: List[dict]):
+        """Пересчитать множители проекта по объёму поданных заявок"""
+        by_server = {entry["server_name"]: entry for entry in flow}
+        for server in self.base[project_key]:
+            key = (project_key, server)
+            entry = by_server.get(server, {})
+            target = self.target_factor(entry.get("buy_amount", 0), entry.get("sell_amount", 0))
+            previous = self.factors.get(key, 1.0)
+            self.factors[key] = previous + PRICING_SMOOTHING * (target - previous)
+
+    def publish(self):
+        prices = {}
+        for project_key, servers in self.base.items():
+            prices[project_key] = {}
+            for server, data in servers.items():
+                factor = self.factors.get((project_key, server), 1.0)
+                prices[project_key][server] = {
+                    **data,
+                    "sellPrice": round(data["sellPrice"] * factor),
+                    "buyPrice": round(data["buyPrice"] * factor),
+                }
+        self.table = freeze_prices(prices)
+        self.updated = datetime.now(timezone.utc)
+
+    async def refresh(self):
+        for project_key in self.base:
+            flow = await api_client.get_order_flow(project_key, PRICING_WINDOW_HOURS)
+            # Нет ответа (сбой API или бэкенд без /orders/stats/flow) — множители не трогаем
+            if flow is not None:
+                self.update(project_key, flow)
+        self.publish()
+
+    async def run(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"[PRICES] Ошибка пересчёта цен: {e}")
+            await asyncio.sleep(PRICING_REFRESH)
+
+price_engine = PriceEngine(PROJECTS)
+
 # ==========================================
 # BAN CHECK MIDDLEWARE
 # ==========================================
@@ -367,8 +926,11 @@ async def check_ban_middleware(handler, event, data):
     if user_id == ADMIN_USER_ID:
         return await handler(event, data)
     
-    # Проверяем блокировку
-    ban_status = await api_client.check_user_banned(user_id)
+    # Проверяем блокировку: локально, если фильтр синхронизирован, иначе через API
+    if ban_filter.fresh():
+        ban_status = ban_filter.check(user_id)
+    else:
+        ban_status = await api_client.check_user_banned(user_id)
     
     if ban_status.get('banned'):
         # Пользователь заблокирован
@@ -392,7 +954,9 @@ async def check_ban_middleware(handler, event, data):
     # Пользователь не заблокирован, продолжаем
     return await handler(event, data)
 
-# Применяем middleware
+# Применяем middleware (антифлуд — outer, срабатывает раньше фильтров и проверки бана)
+router.message.outer_middleware(throttle_middleware)
+router.callback_query.outer_middleware(throttle_middleware)
 router.message.middleware(check_ban_middleware)
 router.callback_query.middleware(check_ban_middleware)
 
@@ -465,8 +1029,7 @@ async def get_servers_menu(project_key: str, action: str = "buy") -> InlineKeybo
 
 def get_amount_menu(project_key: str, server: str, action: str = "buy") -> InlineKeyboardMarkup:
     """Генерация меню с ценами на основе выбранного сервера"""
-    prices = PROJECTS[project_key]["prices"]
-    server_data = prices.get(server, {"sellPrice": 700, "buyPrice": 350})
+    server_data = price_engine.price(project_key, server)
 
     if action == "buy":
         price_per_kk = server_data["sellPrice"]
@@ -494,8 +1057,7 @@ def get_amount_menu(project_key: str, server: str, action: str = "buy") -> Inlin
 
 def get_server_price(project_key: str, server: str, action: str = "buy") -> int:
     """Получить цену за 1кк для сервера"""
-    prices = PROJECTS[project_key]["prices"]
-    server_data = prices.get(server, {"sellPrice": 700, "buyPrice": 350})
+    server_data = price_engine.price(project_key, server)
     return server_data["sellPrice"] if action == "buy" else server_data["buyPrice"]
 
 def get_purchase_menu() -> InlineKeyboardMarkup:
@@ -509,39 +1071,100 @@ def get_back_menu() -> InlineKeyboardMarkup:
     buttons = [[InlineKeyboardButton(text="◀️ В главное меню", callback_data="back_to_main")]]
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
+# Отпечатки последнего отрисованного содержимого: (chat_id, message_id) -> (fingerprint, photo_path)
+_rendered_messages: "OrderedDict[tuple, tuple]" = OrderedDict()
+
+# Счётчики сэкономленных вызовов Bot API
+EDIT_STATS = {"saved_calls": 0, "skipped_edits": 0, "caption_edits": 0, "not_modified": 0}
+
+def render_fingerprint(text: str, markup: Optional[InlineKeyboardMarkup], photo_path: Optional[str]) -> str:
+    """Отпечаток содержимого сообщения: текст + клавиатура + фото"""
+    markup_json = markup.model_dump_json(exclude_none=True) if markup else ""
+    return hashlib.sha1(f"{text}\0{markup_json}\0{photo_path or ''}".encode()).hexdigest()
+
+def remember_render(message: Message, fingerprint: str, photo_path: Optional[str]):
+    """Запомнить, что сейчас отображается в сообщении"""
+    key = (message.chat.id, message.message_id)
+    _rendered_messages[key] = (fingerprint, photo_path)
+    _rendered_messages.move_to_end(key)
+    while len(_rendered_messages) > RENDERED_MESSAGES_MAX:
+        _rendered_messages.popitem(last=False)
+
+def forget_render(message: Message):
+    _rendered_messages.pop((message.chat.id, message.message_id), None)
+
 async def send_or_edit_message(callback: CallbackQuery, text: str, markup: InlineKeyboardMarkup, photo_path: str = None):
+    message = callback.message
+    photo_path = resolve_menu_image(photo_path)
+    if not (photo_path and os.path.exists(photo_path)):
+        photo_path = None
+    fingerprint = render_fingerprint(text, markup, photo_path)
+    previous = _rendered_messages.get((message.chat.id, message.message_id))
+
+    # Содержимое не изменилось (например, дважды нажали «Назад») — ничего не отправляем
+    if previous and previous[0] == fingerprint:
+        EDIT_STATS["skipped_edits"] += 1
+        EDIT_STATS["saved_calls"] += 1
+        return
+
     try:
-        has_photo = callback.message.photo is not None and len(callback.message.photo) > 0
-        if photo_path and os.path.exists(photo_path):
+        has_photo = message.photo is not None and len(message.photo) > 0
+        if photo_path:
             from aiogram.types import InputMediaPhoto
             if has_photo:
-                await callback.message.edit_media(
-                    media=InputMediaPhoto(media=FSInputFile(photo_path), caption=text),
-                    reply_markup=markup
-                )
+                if previous and previous[1] == photo_path:
+                    # Фото то же — меняем только подпись, без повторной загрузки файла
+                    await message.edit_caption(caption=text, reply_markup=markup)
+                    EDIT_STATS["caption_edits"] += 1
+                else:
+                    await message.edit_media(
+                        media=InputMediaPhoto(media=FSInputFile(photo_path), caption=text),
+                        reply_markup=markup
+                    )
+                remember_render(message, fingerprint, photo_path)
             else:
-                await callback.message.delete()
-                await callback.message.answer_photo(
+                await message.delete()
+                forget_render(message)
+                sent = await message.answer_photo(
                     photo=FSInputFile(photo_path),
                     caption=text,
                     reply_markup=markup
                 )
+                remember_render(sent, fingerprint, photo_path)
         else:
             if has_photo:
-                await callback.message.delete()
-                await callback.message.answer(text, reply_markup=markup)
+                await message.delete()
+                forget_render(message)
+                sent = await message.answer(text, reply_markup=markup)
+                remember_render(sent, fingerprint, None)
             else:
-                await callback.message.edit_text(text, reply_markup=markup)
+                await message.edit_text(text, reply_markup=markup)
+                remember_render(message, fingerprint, None)
+    except TelegramBadRequest as e:
+        if "message is not modified" in str(e):
+            # Telegram уже показывает это содержимое — удалять и переотправлять не нужно
+            EDIT_STATS["not_modified"] += 1
+            EDIT_STATS["saved_calls"] += 2
+            remember_render(message, fingerprint, photo_path)
+            return
+        logger.error(f"Ошибка при отправке/редактировании сообщения: {e}")
+        await resend_message(message, text, markup, photo_path, fingerprint)
     except Exception as e:
         logger.error(f"Ошибка при отправке/редактировании сообщения: {e}")
-        try:
-            await callback.message.delete()
-            if photo_path and os.path.exists(photo_path):
-                await callback.message.answer_photo(photo=FSInputFile(photo_path), caption=text, reply_markup=markup)
-            else:
-                await callback.message.answer(text, reply_markup=markup)
-        except Exception as e2:
-            logger.error(f"Ошибка в fallback: {e2}")
+        await resend_message(message, text, markup, photo_path, fingerprint)
+
+async def resend_message(message: Message, text: str, markup: InlineKeyboardMarkup, photo_path: Optional[str], fingerprint: str):
+    """Fallback: удалить сообщение и отправить заново"""
+    try:
+        forget_render(message)
+        await message.delete()
+        if photo_path:
+            sent = await message.answer_photo(photo=FSInputFile(photo_path), caption=text, reply_markup=markup)
+        else:
+            sent = await message.answer(text, reply_markup=markup)
+        remember_render(sent, fingerprint, photo_path)
+    except Exception as e2:
+        logger.error(f"Ошибка в fallback: {e2}")
 
 # --- Проверка подписки ---
 async def is_subscribed(user_id: int) -> bool:
@@ -582,11 +1205,14 @@ async def cmd_start(message: Message, state: FSMContext):
     await state.clear()
 
     welcome_text = "<b>Привет! Благодарим за выбор нашего магазина.</b>"
-    photo_path = MENU_IMAGES["main"]
+    photo_path = resolve_menu_image(MENU_IMAGES["main"])
+    markup = get_main_menu()
     if os.path.exists(photo_path):
-        await message.answer_photo(photo=FSInputFile(photo_path), caption=welcome_text, reply_markup=get_main_menu())
+        sent = await message.answer_photo(photo=FSInputFile(photo_path), caption=welcome_text, reply_markup=markup)
+        remember_render(sent, render_fingerprint(welcome_text, markup, photo_path), photo_path)
     else:
-        await message.answer(welcome_text, reply_markup=get_main_menu())
+        sent = await message.answer(welcome_text, reply_markup=markup)
+        remember_render(sent, render_fingerprint(welcome_text, markup, None), None)
 
 @router.message(Command("help"))
 async def cmd_help(message: Message):
@@ -611,13 +1237,21 @@ async def cmd_help(message: Message):
 async def cmd_stats(message: Message):
     user_id = message.from_user.id
 
-    orders = await api_client.get_orders({"user_id": user_id, "source": "bot"})
+    summary = await api_client.get_user_stats(user_id, source="bot")
+    if summary is None:
+        # Старый бэкенд: считаем по списку заявок
+        orders = await api_client.get_orders({"user_id": user_id, "source": "bot"})
+        summary = {"orders": len(orders), "by_type": {}}
 
     stats_text = f"""<b>📊 Ваша статистика
 
 💤 Пользователь: {message.from_user.first_name}
 🔐 Username: @{message.from_user.username or 'Не указано'}
-📦 Количество заявок: {len(orders)}</b>"""
+📦 Количество заявок: {summary['orders']}</b>"""
+    for order_type, label in (("buy", "🛒 Покупка"), ("sell", "💰 Продажа")):
+        entry = summary["by_type"].get(order_type)
+        if entry:
+            stats_text += f"\n{label}: {entry['orders']} шт., {entry['amount'] // 1000000}кк"
 
     await message.answer(stats_text)
 
@@ -657,6 +1291,9 @@ async def cmd_admin(message: Message):
 /unban &lt;user_id или @username&gt; - Разблокировать
 /banned - Список заблокированных
 
+📤 Выгрузка:
+/export [orders|bans] [csv|ndjson] - Файл .gz
+
 📊 Статистика:
 /stats_all - Общая статистика
 /prices - Текущие цены серверов</b>"""
@@ -699,7 +1336,7 @@ async def cmd_orders(message: Message):
         else:
             date_str = "?"
 
-        status_emoji = "✅" if status == "approved" else "⏳" if status == "pending" else "❌"
+        status_emoji = {"approved": "✅", "pending": "⏳", "completed": "🤝"}.get(status, "❌")
 
         text += f"""<b>{action}</b> {status_emoji}
 💤 @{username} | 🎮 {project} - {server}
@@ -765,7 +1402,9 @@ async def cmd_orders_sell(message: Message):
         status = order.get("status", "pending")
         order_id = order.get("id", "?")
 
-        status_text = "✅ Одобрено" if status == "approved" else "⏳ Ожидает" if status == "pending" else "❌ Отклонено"
+        status_text = {
+            "approved": "✅ Одобрено", "pending": "⏳ Ожидает", "completed": "🤝 Исполнено"
+        }.get(status, "❌ Отклонено")
 
         text += f"<b>🆔</b> <code>{order_id[:8]}</code> | {status_text}\n"
         text += f"@{username} | {server} | {amount}кк | {price}₽\n\n"
@@ -801,6 +1440,33 @@ async def cmd_orders_pending(message: Message):
 
     await message.answer(text)
 
+@router.message(Command("stats_all"))
+async def cmd_stats_all(message: Message):
+    """Общая статистика: объёмы по серверам и сэкономленные вызовы Bot API"""
+    if not is_admin(message.from_user.id):
+        await message.answer("<b>❌ Доступ запрещен</b>")
+        return
+
+    sellers, buyers = await asyncio.gather(
+        api_client.get_server_stats("GTA5RP"), api_client.get_buyer_stats("GTA5RP")
+    )
+    text = "<b>📊 Общая статистика GTA5RP</b>\n\n"
+    for label, stats, count_field in (
+        ("💰 Продажа", sellers, "total_sellers"), ("🛒 Покупка", buyers, "total_buyers")
+    ):
+        users = sum(entry.get(count_field, 0) for entry in stats)
+        amount = sum(entry.get("total_amount", 0) for entry in stats)
+        text += f"{label}: {len(stats)} серв., {users} польз., {amount // 1000000}кк\n"
+
+    text += (
+        f"\n<b>⚡️ Bot API с запуска</b>\n"
+        f"Сэкономлено вызовов: {EDIT_STATS['saved_calls']}\n"
+        f"Пропущено одинаковых правок: {EDIT_STATS['skipped_edits']}\n"
+        f"Правок только подписи: {EDIT_STATS['caption_edits']}\n"
+        f"Ответов «not modified»: {EDIT_STATS['not_modified']}"
+    )
+    await message.answer(text)
+
 @router.message(Command("prices"))
 async def cmd_prices(message: Message):
     """Показать цены серверов"""
@@ -809,8 +1475,14 @@ async def cmd_prices(message: Message):
         return
 
     text = "<b>💰 Цены GTA5RP (₽ за 1кк):</b>\n\n"
-    for server, data in GTA5RP_SERVERS.items():
-        text += f"{server}: покупка {data['sellPrice']}₽ | продажа {data['buyPrice']}₽\n"
+    for server, data in price_engine.table["GTA5RP"].items():
+        text += f"{server}: покупка {data['sellPrice']}₽ | продажа {data['buyPrice']}₽"
+        base = GTA5RP_SERVERS[server]
+        if data["sellPrice"] != base["sellPrice"]:
+            text += f" (база {base['sellPrice']}₽ | {base['buyPrice']}₽)"
+        text += "\n"
+    if price_engine.updated:
+        text += f"\n<i>Пересчитано: {price_engine.updated.strftime('%d.%m.%Y %H:%M')} UTC</i>"
 
     await message.answer(text)
 
@@ -831,7 +1503,7 @@ async def cmd_approve_order(message: Message):
             await message.answer(f"<b>❌ Заявка не найдена</b>")
             return
 
-        updated_order = await api_client.approve_order(order["id"])
+        updated_order = await api_client.approve_order(order["id"], actor=actor_of(message))
 
         if updated_order:
             await message.answer(f"""<b>✅ Заявка одобрена</b>
@@ -880,7 +1552,7 @@ async def cmd_reject_order(message: Message):
             await message.answer(f"<b>❌ Заявка не найдена</b>")
             return
 
-        updated_order = await api_client.reject_order(order["id"])
+        updated_order = await api_client.reject_order(order["id"], actor=actor_of(message))
 
         if updated_order:
             await message.answer(f"""<b>❌ Заявка отклонена</b>
@@ -927,7 +1599,7 @@ async def cmd_delete_order(message: Message):
             await message.answer(f"<b>❌ Заявка не найдена</b>")
             return
 
-        success = await api_client.delete_order(order["id"])
+        success = await api_client.delete_order(order["id"], actor=actor_of(message))
 
         if success:
             await message.answer(f"""<b>🗑 Заявка удалена</b>
@@ -968,7 +1640,7 @@ async def cmd_edit_order(message: Message):
         updated_order = await api_client.update_order(order["id"], {
             "amount": new_amount,
             "price": new_price
-        })
+        }, actor=actor_of(message))
 
         if updated_order:
             await message.answer(f"""<b>✏️ Заявка обновлена</b>
@@ -1035,10 +1707,15 @@ async def cmd_ban(message: Message):
             user_id=user_id,
             username=username,
             days=days,
-            banned_by=message.from_user.username or "admin"
+            banned_by=message.from_user.username or "admin",
+            actor=actor_of(message)
         )
         
         if success:
+            # Сразу обновляем локальный фильтр, не дожидаясь синхронизации
+            expires_ms = int((time.time() + days * 86400) * 1000) if days else 0
+            ban_filter.local_ban(int(user_id), expires_ms)
+            
             ban_text = f"<b>✅ Пользователь заблокирован</b>\n\n"
             ban_text += f"👤 User ID: <code>{user_id}</code>\n"
             if username:
@@ -1102,9 +1779,10 @@ async def cmd_unban(message: Message):
                 return
         
         # Разблокируем пользователя
-        success = await api_client.unban_user(user_id)
+        success = await api_client.unban_user(user_id, actor=actor_of(message))
         
         if success:
+            ban_filter.local_unban(int(user_id))
             await message.answer(f"<b>✅ Пользователь {target} разблокирован</b>")
             
             # Попытаемся уведомить пользователя
@@ -1169,9 +1847,10 @@ async def cmd_unban_short(message: Message):
     
     try:
         user_id = int(message.text.split("_")[1])
-        success = await api_client.unban_user(user_id)
+        success = await api_client.unban_user(user_id, actor=actor_of(message))
         
         if success:
+            ban_filter.local_unban(user_id)
             await message.answer(f"<b>✅ Пользователь {user_id} разблокирован</b>")
             try:
                 await bot.send_message(
@@ -1187,6 +1866,50 @@ async def cmd_unban_short(message: Message):
         logger.error(f"Error in unban_short: {e}")
         await message.answer("<b>❌ Ошибка выполнения команды</b>")
 
+# ========================================
+# ВЫГРУЗКА
+# ========================================
+
+@router.message(Command("export"))
+async def cmd_export(message: Message):
+    """Выгрузка в файл: /export [orders|bans] [csv|ndjson]"""
+    if not is_admin(message.from_user.id):
+        await message.answer("<b>❌ Доступ запрещен</b>")
+        return
+    
+    parts = message.text.split()
+    kind = parts[1] if len(parts) > 1 else "orders"
+    fmt = parts[2] if len(parts) > 2 else "csv"
+    if kind not in ("orders", "bans") or fmt not in ("csv", "ndjson"):
+        await message.answer("<b>❌ Использование: /export [orders|bans] [csv|ndjson]</b>\n\nПример:\n/export orders csv\n/export bans ndjson")
+        return
+    
+    await message.answer("<b>⏳ Готовлю выгрузку...</b>")
+    
+    # Файл пишется на диск по кускам — память не зависит от числа строк
+    fd, path = tempfile.mkstemp(suffix=".gz")
+    os.close(fd)
+    try:
+        filename = await api_client.download_export(kind, fmt, path)
+        if not filename:
+            await message.answer("<b>❌ Ошибка выгрузки</b>")
+            return
+        
+        size = os.path.getsize(path)
+        if size > EXPORT_MAX_DOCUMENT_SIZE:
+            await message.answer(f"<b>❌ Файл слишком большой для Telegram ({size // (1024 * 1024)} МБ)</b>")
+            return
+        
+        await message.answer_document(
+            FSInputFile(path, filename=filename),
+            caption=f"<b>📤 Выгрузка {'заявок' if kind == 'orders' else 'банов'} ({fmt.upper()}, gzip)</b>"
+        )
+    except Exception as e:
+        logger.error(f"Error in export command: {e}")
+        await message.answer("<b>❌ Ошибка выполнения команды</b>")
+    finally:
+        os.remove(path)
+
 # --- Обработчики action (Купить/Продать) ---
 @router.callback_query(F.data.startswith("action_"))
 async def handle_action(callback: CallbackQuery, state: FSMContext):
@@ -1295,14 +2018,32 @@ async def handle_amount(callback: CallbackQuery, state: FSMContext):
         await callback.answer()
         return
 
+    user_id = callback.from_user.id
+    username = callback.from_user.username or "без_username"
+    idempotency_key = make_idempotency_key(user_id, callback.message, callback.data)
+
+    async with order_lock(user_id):
+        # Повторное нажатие на ту же кнопку — заявка уже создана
+        if get_recent_order(idempotency_key):
+            await callback.answer("✅ Заявка уже создана")
+            return
+
+        if not project or not server:
+            await callback.answer()
+            return
+
+        await create_order_from_callback(
+            callback, state, project, server, action, idempotency_key, user_id, username
+        )
+
+async def create_order_from_callback(callback: CallbackQuery, state: FSMContext, project: str, server: str,
+                                     action: str, idempotency_key: str, user_id: int, username: str):
+    """Создание заявки по нажатию amount_* (вызывается под локом пользователя)"""
     parts = callback.data.split("_")
     amount_kk = int(parts[1])
     price = float(parts[2])
     amount = amount_kk * 1_000_000
 
-    user_id = callback.from_user.id
-    username = callback.from_user.username or "без_username"
-
     order_data = {
         "order_type": action,
         "project": project,
@@ -1314,9 +2055,11 @@ async def handle_amount(callback: CallbackQuery, state: FSMContext):
         "source": "bot"
     }
 
-    created_order = await api_client.create_order(order_data)
+    created_order = await api_client.create_order(order_data, idempotency_key=idempotency_key)
 
     if created_order:
+        remember_order(idempotency_key, created_order)
+
         if action == "buy":
             order_text = f"""<b>✅ Заявка на покупку создана!</b>
 
@@ -1345,20 +2088,22 @@ async def handle_amount(callback: CallbackQuery, state: FSMContext):
 
         await send_or_edit_message(callback, order_text, menu)
 
-        # ✅ ИСПРАВЛЕНО: Уведомление admin напрямую через бот при любой новой заявке
-        type_label = "🛒 Покупка" if action == "buy" else "💰 Продажа"
-        status_label = "✅ Одобрено" if action == "buy" else "⏳ Ожидает модерации"
-        await notify_admin(
-            f"🧾 <b>Новая заявка</b>\n\n"
-            f"Тип: <b>{type_label}</b>\n"
-            f"Статус: {status_label}\n"
-            f"Пользователь: @{username}\n"
-            f"Проект: {PROJECTS[project]['name']}\n"
-            f"Сервер: {server}\n"
-            f"Количество: {amount_kk}кк\n"
-            f"Сумма: {price}₽\n"
-            f"Источник: bot"
-        )
+        # Backend вернул ранее созданную заявку (например, после перезапуска бота) — админ уже уведомлён
+        if not created_order.get("duplicate"):
+            # ✅ ИСПРАВЛЕНО: Уведомление admin напрямую через бот при любой новой заявке
+            type_label = "🛒 Покупка" if action == "buy" else "💰 Продажа"
+            status_label = "✅ Одобрено" if action == "buy" else "⏳ Ожидает модерации"
+            await notify_admin(
+                f"🧾 <b>Новая заявка</b>\n\n"
+                f"Тип: <b>{type_label}</b>\n"
+                f"Статус: {status_label}\n"
+                f"Пользователь: @{username}\n"
+                f"Проект: {PROJECTS[project]['name']}\n"
+                f"Сервер: {server}\n"
+                f"Количество: {amount_kk}кк\n"
+                f"Сумма: {price}₽\n"
+                f"Источник: bot"
+            )
     else:
         await callback.answer("❌ Ошибка создания заявки", show_alert=True)
 
@@ -1423,12 +2168,24 @@ async def main():
     logger.info("Бот запускается...")
     logger.info(f"API_BASE_URL: {API_BASE_URL}")
     logger.info(f"ADMIN_USER_ID: {ADMIN_USER_ID}")
+    await asyncio.to_thread(prepare_menu_images)
     dp.include_router(router)
+    ban_filter_task = asyncio.create_task(ban_filter.run())
+    price_task = asyncio.create_task(price_engine.run())
     await bot.delete_webhook(drop_pending_updates=True)
     logger.info("Бот успешно запущен!")
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        ban_filter_task.cancel()
+        price_task.cancel()
+        logger.info(f"Сэкономлено вызовов Bot API: {EDIT_STATS}")
 
 if __name__ == "__main__":
+    # Шаг сборки: только подготовить картинки меню и выйти
+    if "--prepare-images" in sys.argv:
+        prepare_menu_images()
+        sys.exit(0)
     try:
         asyncio.run(main())
     except KeyboardInterrupt: